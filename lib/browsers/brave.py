@@ -33,26 +33,23 @@ class BraveBrowser(BaseBrowser):
         y2 = int(h - 1)
         roi = Rect(x1, y1, x2, y2)
 
-        ocr = frame.subrect(roi).ocr
+        img = frame.subrect(roi)
 
-        log.notice("OCR items:")
-        for item in ocr:
-            log.notice(f"  {item}")
-
-        brave_label = ocr.match('brave').best('top')
-        close_label = ocr.match('close').best('bottom')
+        brave_label = img.find_label('brave', key='top')
         if brave_label is None:
             return None
+
+        close_label = img.find_label('close', key='bottom')
         if close_label is None:
             return None
 
         log.notice(">>> Detected Brave popup <<<")
-        log.screenshot('brave-popup', ocr.img)
+        log.screenshot('brave-popup', img)
 
         popup = Dialog('Brave', None)
 
         if autoclose:
             log.info("BraveBrowser.check_popups: close_label={close_label}")
-            self.vm.click(close_label, style='robot')
+            self.vm.mouse_click(close_label.x, close_label.y, style='robot')
 
         return popup
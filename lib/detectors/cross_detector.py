@@ -1,4 +1,5 @@
 from collections import namedtuple
+from functools import lru_cache
 from math import sqrt, pi, atan2
 
 import cv2
@@ -14,6 +15,10 @@ Point = namedtuple('Point', ['x','y'])
 Cross = namedtuple('Cross', ['probability', 'rect'])
 Sequence = namedtuple('Sequence', ['start', 'length'])
 
+MIN_CROSS_SIDE = 5
+MAX_CROSS_SIDE = 64
+MAX_CROSS_ASPECT = 2.0
+
 def coef(p1, p2):
     return p2.y - p1.y, p1.x - p2.x, (p2.x - p1.x) * p1.y + (p1.y - p2.y) * p1.x
 
@@ -24,39 +29,57 @@ def middle(x, y, p1, p2, p3, p4): #pylint: disable=too-many-arguments
     s2 = a2 * x + b2 * y + c2
     return (s1 >= 0.0) ^ (s2 >= 0.0)
 
+@lru_cache(maxsize=1024)
+def ideal_cross(w, h, d):
+    dx = d * sqrt(w*w+h*h) / h / 2
+    dy = d * sqrt(w*w+h*h) / w / 2
+
+    p11 = Point(0, h - dy)
+    p12 = Point(w - dx, 0)
+    p21 = Point(dx, h)
+    p22 = Point(w, dy)
+
+    p31 = Point(0, dy)
+    p32 = Point(w - dx, h)
+    p41 = Point(dx, 0)
+    p42 = Point(w, h - dy)
+
+    xx = np.arange(w, dtype=np.float64)[np.newaxis,:] + 0.5
+    yy = np.arange(h, dtype=np.float64)[:,np.newaxis] + 0.5
+    is_cross = middle(xx, yy, p11, p12, p21, p22) | middle(xx, yy, p31, p32, p41, p42)
+
+    ideal = np.where(is_cross, 255, 0).astype(np.uint8)
+    ideal.flags.writeable = False
+    return ideal
+
 def detect_cross(objname, orig_img):
     w, h = orig_img.width, orig_img.height
     log.info(f"Detect: objname={objname}; img.resolution={w}x{h};")
     imdebug('start', orig_img)
 
-    img = orig_img.buf
-    if len(img.shape) == 3:
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-    adaptive_thresh = cv2.adaptiveThreshold(
-        img, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-        cv2.THRESH_BINARY, 11, 2)
-
-    cleaned1 = adaptive_thresh
-    cleaned2 = 255 - cleaned1
+    ox, oy = orig_img.rect.x1, orig_img.rect.y1
+    cleaned1 = orig_img.adaptive_threshold(11, 2)
+    cleaned2 = orig_img.adaptive_threshold(11, 2, inverted=True)
     imdebug('cleaned1', cleaned1)
     imdebug('cleaned2', cleaned2)
 
     candidates = []
 
-    p11, p12, p21, p22 = None, None, None, None
-    p31, p32, p41, p42 = None, None, None, None
-
     for mark, cleaned in (('org', cleaned1), ('inv', cleaned2)):
-        num_labels, labels = cv2.connectedComponents(cleaned)
+        num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(cleaned)
         for label in range(0, num_labels):
-            mask = (labels == label).astype(np.uint8) * 255
-            x, y, w, h = cv2.boundingRect(mask)
+            x, y, w, h, area = map(int, stats[label])
 
-            if w < 5 or h < 5:
+            if min(w, h) < MIN_CROSS_SIDE or max(w, h) > MAX_CROSS_SIDE:
+                continue
+            if max(w, h) > MAX_CROSS_ASPECT * min(w, h):
+                continue
+            if area < max(w, h):
                 continue
 
-            imdebug(f'region-{mark}-{label}', mask)
+            if istest():
+                mask = (labels[y:y+h, x:x+w] == label).astype(np.uint8) * 255
+                imdebug(f'region-{mark}-{label}', mask)
 
             trimmed = cleaned[y:y+h, x:x+w]
             imdebug(f'trimmed-{mark}-{label}', trimmed)
@@ -82,30 +105,7 @@ def detect_cross(objname, orig_img):
                 continue
 
             d = alts.pop(0)
-            dx = d * sqrt(w*w+h*h) / h / 2
-            dy = d * sqrt(w*w+h*h) / w / 2
-
-            p11 = Point(0, h - dy)
-            p12 = Point(w - dx, 0)
-            p21 = Point(dx, h)
-            p22 = Point(w, dy)
-
-            p31 = Point(0, dy)
-            p32 = Point(w - dx, h)
-            p41 = Point(dx, 0)
-            p42 = Point(w, h - dy)
-
-            def is_cross(x, y):
-                return middle(x, y, p11, p12, p21, p22) or middle(x, y, p31, p32, p41, p42)
-
-            ideal = np.zeros((h, w), np.uint8)
-            for xx in range(w):
-                for yy in range(h):
-                    cx = xx + 0.5
-                    cy = yy + 0.5
-                    if is_cross(cx, cy):
-                        ideal[yy,xx] = 255
-
+            ideal = ideal_cross(w, h, d)
             imdebug(f'ideal-{mark}-{label}', ideal)
 
             white_mask = ideal == 255
@@ -123,7 +123,8 @@ def detect_cross(objname, orig_img):
 
             wq, bq = qwm / qw, qbm / qb
             if wq > 0.7 and bq > 0.7:
-                candidates.append(Cross(0.5 * (wq + bq), Rect(x, y, x+w, y+h)))
+                rect = Rect(x, y, x+w, y+h).move(ox, oy)
+                candidates.append(Cross(0.5 * (wq + bq), rect))
 
     if not candidates:
         return None
@@ -154,22 +155,22 @@ def find_sequences(line, minlen=50):
 
     return result
 
-def detect_xpanel(objname, orig_img, x, y):
+def detect_xpanel(objname, orig_img, x, y, *, pyramid=1):
     w, h = orig_img.width, orig_img.height
     log.info(f"Detect: objname={objname}; img.resolution={w}x{h}; point={(x,y)}")
     imdebug('start', orig_img)
 
-    gray_img = orig_img.make_gray()
-    imdebug('gray', gray_img)
+    imdebug('gray', orig_img.gray())
 
-    blurred = cv2.GaussianBlur(gray_img.buf, (9, 9), 0)
+    blurred = orig_img.blur((9, 9))
     imdebug('blurred', blurred)
 
-    edges = cv2.Canny(blurred, 50, 150)
+    edges = orig_img.canny(50, 150, ksize=(9, 9))
     imdebug('edges', edges)
 
-    lsd = cv2.createLineSegmentDetector(0)
-    lines, width, prec, nfa = lsd.detect(gray_img.buf)
+    lines, width, prec, nfa = orig_img.lsd(pyramid, 25)
+    if lines is None:
+        lines = []
 
     vlines, hlines = [], []
     tmp = orig_img.clone()
@@ -321,7 +322,7 @@ def detect_xpanel(objname, orig_img, x, y):
     """
 
 def _init():
-    register('cross', detect_cross)
+    register('cross', detect_cross, offloaded=True)
     register('xpanel', detect_xpanel)
 
 _init()
@@ -1,20 +1,89 @@
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
+from copy import copy
 from statistics import mean
 
 import cv2
+import numpy as np
 
 import log
 from detectors import register
+from detectors.panel_layouts import layouts
+from environment import environment
 from testing import istest, imdebug
 from timer import age
 from utils import Line, Rect, fail, nice
 
-def detect_lines(img, minlength=10):
-    gray_img = img.make_gray()
-    imdebug('gray', gray_img)
+LINE_DTYPE = np.dtype([
+    ('x1', np.int32),
+    ('y1', np.int32),
+    ('x2', np.int32),
+    ('y2', np.int32),
+    ('length', np.float64),
+    ('phi', np.float64),
+    ('cx', np.int32),
+    ('cy', np.int32),
+    ('horizontal', np.bool_),
+    ('vertical', np.bool_),
+    ('index', np.int32),
+])
+
+MAX_AXIS_DEGREE = 1
+PANEL_DIFF_THRESHOLD = 16
+PANEL_REDETECT_RATIO = 0.5
+PANEL_HISTORY_SIZE = 4
+PANEL_EDGE_MARGIN = 2
+
+previous_panels = OrderedDict()
+
+def clone_frame(img):
+    return np.copy(img.buf)
+
+def make_line_array(lines):
+    coords = np.array([ tuple(line) for line in lines ], dtype=np.int32).reshape(-1, 4)
+    x1, y1, x2, y2 = coords.T
+
+    result = np.empty(len(coords), dtype=LINE_DTYPE)
+    result['x1'], result['y1'], result['x2'], result['y2'] = x1, y1, x2, y2
+
+    dx, dy = np.abs(x2 - x1), np.abs(y2 - y1)
+    result['length'] = np.hypot(dx, dy)
+    result['phi'] = np.arctan2(dy, dx)
+    result['cx'] = np.trunc(0.5 * (x1 + x2))
+    result['cy'] = np.trunc(0.5 * (y1 + y2))
+
+    Δφ = np.pi * MAX_AXIS_DEGREE / 180.0
+    result['horizontal'] = result['phi'] <= Δφ
+    result['vertical'] = result['phi'] >= 0.5 * np.pi - Δφ
+    result['index'] = np.arange(len(coords))
+    return result
+
+def get_coords(array):
+    return array[['x1', 'y1', 'x2', 'y2']].tolist()
+
+def split_hv_lines(lines):
+    array = make_line_array(lines)
+    harray, varray = array[array['horizontal']], array[array['vertical']]
+    harray['index'] = np.arange(len(harray))
+    varray['index'] = np.arange(len(varray))
+    return harray, varray
+
+def get_bounds(array):
+    xs = np.concatenate((array['x1'], array['x2']))
+    ys = np.concatenate((array['y1'], array['y2']))
+    return Rect(int(xs.min()), int(ys.min()), int(xs.max()), int(ys.max()))
+
+def get_inner_mask(array, rect):
+    x1, y1, x2, y2 = rect
+    return ((array['x1'] >= x1) & (array['x1'] <= x2) & (array['y1'] >= y1) & (array['y1'] <= y2)
+        & (array['x2'] >= x1) & (array['x2'] <= x2) & (array['y2'] >= y1) & (array['y2'] <= y2))
 
-    lsd = cv2.createLineSegmentDetector(0)
-    lines, *tail = lsd.detect(gray_img.buf)
+def detect_lines(img, minlength=10, *, pyramid=1):
+    ox, oy = img.rect.x1, img.rect.y1
+    imdebug('gray', img.gray())
+
+    lines, *tail = img.lsd(pyramid, minlength)
+    if lines is None:
+        lines = []
 
     qlines = len(lines)
     swidth, sprec, snfa = [ nice(item) for item in tail ]
@@ -25,10 +94,10 @@ def detect_lines(img, minlength=10):
         coords = [ int(coord) for coord in line_data[0] ]
         line = Line(*coords)
         if line.length >= minlength:
-            result.append(Line(*coords))
+            result.append(line.move(ox, oy))
 
     if istest():
-        buf = img.clone().buf
+        buf = clone_frame(img)
         for line in result:
             x1, y1, x2, y2 = line
             cv2.line(buf, (x1, y1), (x2, y2), (255, 0, 0), 2)
@@ -36,102 +105,114 @@ def detect_lines(img, minlength=10):
 
     return result
 
-def detect_hv_lines(img, minlength=10):
-    lines = detect_lines(img, minlength=minlength)
-    hlines = [ line for line in lines if line.is_horizontal() ]
-    vlines = [ line for line in lines if line.is_vertical() ]
+def detect_hv_lines(img, minlength=10, *, pyramid=1):
+    lines = detect_lines(img, minlength=minlength, pyramid=pyramid)
+    hlines, vlines = split_hv_lines(lines)
 
     if istest():
-        buf = img.clone().buf
-        for line in vlines:
-            x1, y1, x2, y2 = line
+        buf = clone_frame(img)
+        for x1, y1, x2, y2 in get_coords(vlines):
             cv2.line(buf, (x1, y1), (x2, y2), (0, 255, 0), 2)
         imdebug(f'vlines-minlength-{minlength}', buf)
 
-        buf = img.clone().buf
-        for line in hlines:
-            x1, y1, x2, y2 = line
+        buf = clone_frame(img)
+        for x1, y1, x2, y2 in get_coords(hlines):
             cv2.line(buf, (x1, y1), (x2, y2), (0, 0, 255), 2)
         imdebug(f'hlines-minlength-{minlength}', buf)
 
     return hlines, vlines
 
+def pair_candidates(lines, mincommonlen, centers):
+    qlines = len(lines)
+    if qlines < 2:
+        return []
+
+    lengths = lines['length']
+    centers = np.asarray(centers, dtype=np.float64)
+    order = np.argsort(lengths, kind='stable')
+    sorted_lengths = lengths[order]
+
+    slack = 1e-9
+    starts = np.searchsorted(sorted_lengths, mincommonlen * sorted_lengths * (1.0 - slack))
+    tolerances = (1.0 - mincommonlen) * sorted_lengths * (1.0 + slack) + slack
+
+    result = []
+    for pos in range(1, qlines):
+        start = starts[pos]
+        if start >= pos:
+            continue
+
+        i = order[pos]
+        window = order[start:pos]
+        near = window[np.abs(centers[window] - centers[i]) <= tolerances[pos]]
+        result.extend((min(i, j), max(i, j)) for j in near.tolist())
+
+    result.sort()
+    return result
+
 class Group(list):
     @property
     def length(self):
         return len(self)
 
+    def take(self, lines):
+        return lines[np.array(self, dtype=np.intp)]
+
     def minx(self, lines):
-        return min(
-            min(lines[i].x1 for i in self),
-            min(lines[i].x2 for i in self),
-            )
+        return self.rect(lines).x1
 
     def maxx(self, lines):
-        return max(
-            max(lines[i].x1 for i in self),
-            max(lines[i].x2 for i in self),
-            )
+        return self.rect(lines).x2
 
     def miny(self, lines):
-        return min(
-            min(lines[i].y1 for i in self),
-            min(lines[i].y2 for i in self),
-            )
+        return self.rect(lines).y1
 
     def maxy(self, lines):
-        return max(
-            max(lines[i].y1 for i in self),
-            max(lines[i].y2 for i in self),
-            )
+        return self.rect(lines).y2
 
     def rect(self, lines):
-        x1, y1 = self.minx(lines), self.miny(lines)
-        x2, y2 = self.maxx(lines), self.maxy(lines)
-        return Rect(x1, y1, x2, y2)
+        return get_bounds(self.take(lines))
 
     def split(self, index):
         return (Group(self[:index]), Group(self[index:]))
 
 
+def find_root(parents, i):
+    while parents[i] != i:
+        parents[i] = parents[parents[i]]
+        i = parents[i]
+    return i
+
 def group_lines(lines, axis, *, maxlinediff, mingap):
     qlines = len(lines)
-    lines.sort(key=lambda line: line.length)
-    indexes = list(range(qlines))
-
-    if axis == 'x':
-        def center(line):
-            return 0.5 * (line.x1 + line.x2)
-        def position(line):
-            return 0.5 * (line.y1 + line.y2)
-
-    elif axis == 'y':
-        def center(line):
-            return 0.5 * (line.y1 + line.y2)
-        def position(line):
-            return 0.5 * (line.x1 + line.x2)
-
-    else:
+    lines[:] = lines[np.argsort(lines['length'], kind='stable')]
+
+    xs = 0.5 * (lines['x1'] + lines['x2'].astype(np.float64))
+    ys = 0.5 * (lines['y1'] + lines['y2'].astype(np.float64))
+    if axis not in ('x', 'y'):
         fail("Wrong axis")
+    centers, positions = (xs, ys) if axis == 'x' else (ys, xs)
 
-    for i in range(0, qlines-1):
-        for j in range(i+1, qlines):
-            iline = lines[i]
-            jline = lines[j]
-            Δ = abs(iline.length - jline.length)
-            m = int(0.5 * (iline.length + jline.length))
-            if Δ / m > maxlinediff:
-                continue
+    lengths = lines['length']
+    parents = list(range(qlines))
+    qjoins = 0
+    for i, j in pair_candidates(lines, 1.0 - maxlinediff, centers):
+        Δ = abs(lengths[i] - lengths[j])
+        m = int(0.5 * (lengths[i] + lengths[j]))
+        if Δ / m > maxlinediff:
+            continue
 
-            ci, cj = center(iline), center(jline)
-            offset = abs(cj - ci)
-            if offset / m > maxlinediff:
-                continue
+        offset = abs(centers[j] - centers[i])
+        if offset / m > maxlinediff:
+            continue
+
+        ri, rj = find_root(parents, i), find_root(parents, j)
+        if ri != rj:
+            parents[max(ri, rj)] = min(ri, rj)
+            qjoins += 1
 
-            log.info(f"Join {i}, {j}: {iline}, {jline}")
-            joint_index = min(indexes[i], indexes[j])
-            indexes[i] = joint_index
-            indexes[j] = joint_index
+    indexes = [ find_root(parents, i) for i in range(qlines) ]
+    log.info(f"Joined {qlines} lines along {axis} with {qjoins} joins")
 
     groups = [ Group() for _ in indexes ]
     for i, joint_index in enumerate(indexes):
@@ -142,7 +223,7 @@ def group_lines(lines, axis, *, maxlinediff, mingap):
     result = []
 
     for g in groups:
-        g.sort(key=lambda i: position(lines[i]))
+        g.sort(key=lambda i: positions[i])
 
         while True:
             if len(g) <= 3:
@@ -153,15 +234,14 @@ def group_lines(lines, axis, *, maxlinediff, mingap):
             log.notice(f"Groups! {g}")
             qgaps = 0
             for j, i in enumerate(g):
-                line = lines[i]
-                pos = position(line)
+                pos = positions[i]
                 isgap = last_pos is None or (pos - last_pos > mingap)
                 if isgap:
                     qgaps += 1
                 if qgaps == 3:
                     first_group = j
                 last_pos = pos
-                log.info(f"  view {i}: {line} {pos} {isgap}")
+                log.info(f"  view {i}: {get_coords(lines[i:i+1])[0]} {pos} {isgap}")
                 if qgaps >= 4:
                     log.info("  many gaps, splitting")
                     break
@@ -237,6 +317,10 @@ class PanelLine:
 
         return scoord
 
+def get_panel_lines(array, panel=None):
+    return [ PanelLine(*coords, panel=panel, index=index)
+        for coords, index in zip(get_coords(array), array['index'].tolist()) ]
+
 
 class LinePair:
     def __init__(self, pl1, pl2):
@@ -259,19 +343,31 @@ class LinePair:
         return mean(self.scores)
 
 
-class Panel:
+class Panel: #pylint: disable=too-many-instance-attributes
     def __init__(self, detector, rect):
         self.detector = detector
         self.rect = rect
         self.children = []
-        self.hlines = []
-        self.vlines = []
+        self.harray = make_line_array([])
+        self.varray = make_line_array([])
         self.hpairs = []
         self.vpairs = []
+        self.restored = False
+
+    def walk(self):
+        yield self
+        for child in self.children:
+            yield from child.walk()
 
-    def load_lines(self, hlines, vlines):
-        self.hlines = list(hlines)
-        self.vlines = list(vlines)
+    def load_lines(self, harray, varray):
+        self.harray, self.varray = harray, varray
+
+    @staticmethod
+    def inner_lines(rect, array, used):
+        mask = get_inner_mask(array, rect)
+        if used:
+            mask &= ~np.isin(array['index'], list(used))
+        return array[mask]
 
     def new_child(self, x1, y1, x2, y2, *, used=None): #pylint: disable=too-many-arguments
         detector = self.detector
@@ -289,17 +385,10 @@ class Panel:
         if child_rect == self.rect:
             return 0
 
-        def is_inner_line(pl):
-            if not child_rect.has_line(pl.coords):
-                return False
-            if pl.index in used:
-                return False
-            return True
-
         child = Panel(detector, child_rect)
-        child.hlines = [ pl for pl in self.hlines if is_inner_line(pl) ]
-        child.vlines = [ pl for pl in self.vlines if is_inner_line(pl) ]
-        qh, qv = len(child.hlines), len(child.vlines)
+        child.harray = self.inner_lines(child_rect, self.harray, used)
+        child.varray = self.inner_lines(child_rect, self.varray, used)
+        qh, qv = len(child.harray), len(child.varray)
         log.notice(f"New child: {(x1, y1)} - {(x2, y2)}, {qh} hlines, {qv} vlines.")
 
         if istest():
@@ -308,17 +397,17 @@ class Panel:
             buf = img.subrect(child_rect).clone().buf
             imdebug('panel', buf)
 
-            for pl in child.hlines:
+            for pl in get_panel_lines(child.harray):
                 x1, y1, x2, y2 = pl.coords.move(-child_rect.x1, -child_rect.y1)
                 cv2.line(buf, (x1, y1), (x2, y2), (255, 0, 0), 2)
 
-            for pl in child.vlines:
+            for pl in get_panel_lines(child.varray):
                 x1, y1, x2, y2 = pl.coords.move(-child_rect.x1, -child_rect.y1)
                 cv2.line(buf, (x1, y1), (x2, y2), (0, 0, 255), 2)
 
             imdebug('panel-lines', buf)
 
-            buf = img.clone().buf
+            buf = clone_frame(img)
             x1, y1, x2, y2 = child_rect
             cv2.rectangle(buf, (x1, y1), (x2, y2), (255, 0, 0), 2)
             imdebug('panel-rect', buf)
@@ -331,21 +420,14 @@ class Panel:
         minwidth = int(self.detector.mincommonlen * self.rect.width)
         minlength = self.detector.minlength
 
-        def ishr(pl):
-            line = pl.coords
-            if line.length < minwidth:
-                return False
-            delta = self.rect.width - line.length
-            if delta > minlength:
-                return False
-            return True
-
-        candidates = [ pl for pl in self.hlines if ishr(pl) ]
-        if not candidates:
+        lengths, cys = self.harray['length'], self.harray['cy']
+        indexes = np.flatnonzero((lengths >= minwidth) & (self.rect.width - lengths <= minlength))
+        if len(indexes) == 0:
             log.notice("No candidates for horizontal splits")
             return 0
 
-        candidates.sort(key=lambda pl: pl.coords.cy)
+        indexes = indexes[np.argsort(cys[indexes], kind='stable')]
+        candidates = get_panel_lines(self.harray[indexes], self)
 
         log.notice("Horizontal splits candidates:")
         log.shift(+1)
@@ -356,11 +438,11 @@ class Panel:
             log.shift(-1)
 
         qchildren = 0
-        used = set(pl.index for pl in candidates)
+        used = set(self.harray['index'][indexes].tolist())
         y = self.rect.y1
-        for pl in candidates:
+        for i in indexes:
             x1, x2 = self.rect.x1, self.rect.x2
-            y1, y2 = y, pl.coords.cy
+            y1, y2 = y, int(cys[i])
             y = y2
 
             if abs(y2 - y1) < self.detector.minlength:
@@ -373,19 +455,17 @@ class Panel:
         log.notice(f"Found {qchildren} children")
         return qchildren
 
-    def generate_pairs(self, lines):
-        result = []
-        qlines = len(lines)
-
-        for i in range(0, qlines-1):
-            pl1 = lines[i]
-            line1 = pl1.coords
-            for j in range(i+1, qlines):
-                pl2 = lines[j]
-                line2 = pl2.coords
+    def generate_pairs(self, array):
+        detector = self.detector
+        coords = get_coords(array)
+        indexes = array['index'].tolist()
 
-                if self.detector.is_interesting_pair(line1, line2):
-                    result.append(LinePair(pl1, pl2))
+        result = []
+        for i, j in pair_candidates(array, detector.mincommonlen, array['cx']):
+            if detector.is_interesting_pair(Line(*coords[i]), Line(*coords[j])):
+                pl1 = PanelLine(*coords[i], panel=self, index=indexes[i])
+                pl2 = PanelLine(*coords[j], panel=self, index=indexes[j])
+                result.append(LinePair(pl1, pl2))
 
         return result
 
@@ -424,17 +504,15 @@ class Panel:
 
     def robust_best_hpair(self):
         detector = self.detector
-        lines = self.hlines
+        lines = get_panel_lines(self.harray, self)
+        coords = [ pl.coords for pl in lines ]
         candidates = []
-        qlines = len(lines)
-        for i in range(0, qlines-1):
-            line1 = lines[i].line
-            for j in range(i+1, qlines):
-                line2 = lines[j].line
-                k = detector.estimate_hline_pair(line1, line2)
-                l = int(max(line1.length, line2.length))
-                if k > 0.01:
-                    candidates.append((i, j, int(100*k), l))
+        for i, j in pair_candidates(self.harray, detector.mincommonlen, self.harray['cx']):
+            line1, line2 = coords[i], coords[j]
+            k = detector.estimate_hline_pair(line1, line2)
+            l = int(max(line1.length, line2.length))
+            if k > 0.01:
+                candidates.append((i, j, int(100*k), l))
 
         candidates.sort(key=lambda t: (t[2], t[3]), reverse=True)
 
@@ -447,10 +525,10 @@ class Panel:
                 line2 = lines[j]
                 log.notice(f"{sindex:8s} {k:3d}% {line1} {line2} len={l}")
 
-                buf = detector.orig_img.clone().buf
-                x1, y1, x2, y2 = line1.line
+                buf = detector.clone_img_buf()
+                x1, y1, x2, y2 = line1.coords
                 cv2.line(buf, (x1, y1), (x2, y2), (255, 0, 0), 2)
-                x1, y1, x2, y2 = line2.line
+                x1, y1, x2, y2 = line2.coords
                 cv2.line(buf, (x1, y1), (x2, y2), (255, 0, 0), 2)
                 imdebug(f'{i}-{j}', buf)
 
@@ -467,11 +545,11 @@ class Panel:
 
         # SKIPED try_vsplit
 
-        qh, qv = len(self.hlines), len(self.vlines)
+        qh, qv = len(self.harray), len(self.varray)
         log.notice(f"Panel {self.rect}: {qh} hlines {qv} vlines")
 
-        self.hpairs = self.generate_pairs(self.hlines)
-        self.vpairs = self.generate_pairs(self.vlines)
+        self.hpairs = self.generate_pairs(self.harray)
+        self.vpairs = self.generate_pairs(self.varray)
         log.notice(f"len(hpairs) = {len(self.hpairs)}")
         log.notice(f"len(vpairs) = {len(self.vpairs)}")
 
@@ -494,20 +572,24 @@ class PanelDetector:#pylint: disable=too-many-instance-attributes
     def __init__(self, objname, orig_img, *,
             minlength=24,
             mincommonlen=0.9,
+            pyramid=1,
+            edge_margin=0,
             ): #pylint: disable=too-many-arguments
 
         self.objname = objname
         self.orig_img = orig_img
         self.minlength = minlength
         self.mincommonlen = mincommonlen
+        self.pyramid = pyramid
+        self.edge_margin = edge_margin
 
         self.root = Panel(self, orig_img.rect)
         self.stack = { self.root }
-        self.hlines = []
-        self.vlines = []
+        self.harray = make_line_array([])
+        self.varray = make_line_array([])
 
     def clone_img_buf(self):
-        return self.orig_img.clone().buf
+        return clone_frame(self.orig_img)
 
     def log_lines(self, title, name, panel_lines, color):
         log.info(title)
@@ -522,24 +604,27 @@ class PanelDetector:#pylint: disable=too-many-instance-attributes
         finally:
             log.shift(-1)
 
-    def detect_hv_lines(self):
-        lines = detect_lines(self.orig_img, minlength=self.minlength)
-        hlines = [ line for line in lines if line.is_horizontal() ]
-        vlines = [ line for line in lines if line.is_vertical() ]
-
-        self.hlines = []
-        for i, hline in enumerate(hlines):
-            pl = PanelLine(*hline, panel=self.root, index=i)
-            self.hlines.append(pl)
+    def get_edge_mask(self, array):
+        # Borders of a re-detected panel were split lines of its parent, full detection
+        # never passes them to the child panel
+        m = self.edge_margin
+        result = np.zeros(len(array), dtype=np.bool_)
+        for y in (self.orig_img.rect.y1, self.orig_img.rect.y2):
+            result |= (np.abs(array['y1'] - y) <= m) & (np.abs(array['y2'] - y) <= m)
+        return result
 
-        self.vlines = []
-        for i, vline in enumerate(vlines):
-            pl = PanelLine(*vline, panel=self.root, index=i)
-            self.vlines.append(pl)
+    def detect_hv_lines(self):
+        lines = detect_lines(self.orig_img, minlength=self.minlength, pyramid=self.pyramid)
+        self.harray, self.varray = split_hv_lines(lines)
+        if self.edge_margin > 0:
+            self.harray = self.harray[~self.get_edge_mask(self.harray)]
+            self.harray['index'] = np.arange(len(self.harray))
 
         if istest():
-            self.log_lines("H-Lines:", 'hlines', self.hlines, (0, 0, 255))
-            self.log_lines("V-Lines:", 'vlines', self.vlines, (0, 255, 0))
+            hlines = get_panel_lines(self.harray, self.root)
+            vlines = get_panel_lines(self.varray, self.root)
+            self.log_lines("H-Lines:", 'hlines', hlines, (0, 0, 255))
+            self.log_lines("V-Lines:", 'vlines', vlines, (0, 255, 0))
 
     def is_interesting_pair(self, line1, line2):
         minlen = min(line1.length, line2.length)
@@ -577,17 +662,15 @@ class PanelDetector:#pylint: disable=too-many-instance-attributes
         return 0.5 * (k1 + k2)
 
     def robust_best_hpair(self):
-        lines = self.hlines
+        lines = get_panel_lines(self.harray, self.root)
+        coords = [ pl.coords for pl in lines ]
         candidates = []
-        qlines = len(lines)
-        for i in range(0, qlines-1):
-            line1 = lines[i]
-            for j in range(i+1, qlines):
-                line2 = lines[j]
-                k = self.estimate_hline_pair(line1, line2)
-                l = int(max(line1.length, line2.length))
-                if k > 0.01:
-                    candidates.append((i, j, int(100*k), l))
+        for i, j in pair_candidates(self.harray, self.mincommonlen, self.harray['cx']):
+            line1, line2 = coords[i], coords[j]
+            k = self.estimate_hline_pair(line1, line2)
+            l = int(max(line1.length, line2.length))
+            if k > 0.01:
+                candidates.append((i, j, int(100*k), l))
 
         candidates.sort(key=lambda t: (t[2], t[3]), reverse=True)
 
@@ -605,17 +688,15 @@ class PanelDetector:#pylint: disable=too-many-instance-attributes
         return candidates
 
     def robust_best_vpair(self):
-        lines = self.vlines
+        lines = get_panel_lines(self.varray, self.root)
+        coords = [ pl.coords for pl in lines ]
         candidates = []
-        qlines = len(lines)
-        for i in range(0, qlines-1):
-            line1 = lines[i]
-            for j in range(i+1, qlines):
-                line2 = lines[j]
-                k = self.estimate_vline_pair(line1, line2)
-                l = int(max(line1.length, line2.length))
-                if k > 0.01:
-                    candidates.append((i, j, int(100*k), l))
+        for i, j in pair_candidates(self.varray, self.mincommonlen, self.varray['cy']):
+            line1, line2 = coords[i], coords[j]
+            k = self.estimate_vline_pair(line1, line2)
+            l = int(max(line1.length, line2.length))
+            if k > 0.01:
+                candidates.append((i, j, int(100*k), l))
 
         candidates.sort(key=lambda t: (t[2], t[3]), reverse=True)
 
@@ -639,11 +720,11 @@ class PanelDetector:#pylint: disable=too-many-instance-attributes
 
         start_at = age()
         self.detect_hv_lines()
-        qhlines, qvlines = len(self.hlines), len(self.vlines)
+        qhlines, qvlines = len(self.harray), len(self.varray)
         duration = age() - start_at
         log.info(f"Found {qhlines} horizontal and {qvlines} vertial lines in {duration:.02f} sec")
 
-        self.root.load_lines(self.hlines, self.vlines)
+        self.root.load_lines(self.harray, self.varray)
         self.stack = { self.root }
 
         while len(self.stack) > 0:
@@ -654,9 +735,91 @@ class PanelDetector:#pylint: disable=too-many-instance-attributes
         # vpairs = self.robust_best_vpair()
         # log.notice(f"{len(hpairs)} hpairs and {len(vpairs)} vpairs")
 
-def detect_panels(objname, orig_img, **kwargs):
+        return self.root
+
+    def redetect(self, panel):
+        detector = PanelDetector(self.objname, self.orig_img.subrect(panel.rect),
+            minlength=self.minlength,
+            mincommonlen=self.mincommonlen,
+            pyramid=self.pyramid,
+            edge_margin=PANEL_EDGE_MARGIN,
+        )
+        return detector.run()
+
+    def splice(self, panel, changed, stats):
+        ox, oy = self.orig_img.rect.x1, self.orig_img.rect.y1
+        x1, y1, x2, y2 = panel.rect.move(-ox, -oy)
+        region = changed[y1:y2,x1:x2]
+        if not region.any():
+            stats['reused'] += 1
+            return panel
+
+        if panel.children:
+            # Changes on an inner border of a child may break the split line of the panel
+            m, (rh, rw) = PANEL_EDGE_MARGIN, region.shape
+            outside = np.copy(region)
+            for child in panel.children:
+                cx1, cy1, cx2, cy2 = child.rect.move(-x1 - ox, -y1 - oy)
+                cx1, cy1 = cx1 + m * (cx1 > 0), cy1 + m * (cy1 > 0)
+                cx2, cy2 = cx2 - m * (cx2 < rw), cy2 - m * (cy2 < rh)
+                outside[cy1:cy2,cx1:cx2] = False
+
+            if not outside.any():
+                spliced = copy(panel)
+                spliced.children = [ self.splice(child, changed, stats)
+                    for child in panel.children ]
+                return spliced
+
+        stats['redetected'] += 1
+        return self.redetect(panel)
+
+    def run_incremental(self, previous):
+        gray = self.orig_img.gray()
+        if previous is None:
+            return self.run()
+
+        prev_gray, prev_root = previous
+        if prev_gray.shape != gray.shape or prev_root.rect != self.orig_img.rect:
+            return self.run()
+
+        changed = cv2.absdiff(prev_gray, gray) > PANEL_DIFF_THRESHOLD
+        if changed.mean() > PANEL_REDETECT_RATIO:
+            log.info("Frame changed too much, full panel detection")
+            return self.run()
+
+        stats = { 'reused': 0, 'redetected': 0 }
+        root = self.splice(prev_root, changed, stats)
+        log.info(f"Incremental panels: {stats['reused']} reused, {stats['redetected']} re-detected")
+        return root
+
+def load_layout(detector, data):
+    panel = Panel(detector, Rect(*data['rect']))
+    panel.restored = True
+    panel.children = [ load_layout(detector, child) for child in data['children'] ]
+    return panel
+
+def detect_panels(objname, orig_img, *, source=None, **kwargs):
+    key = (objname, source, orig_img.rect, tuple(sorted(kwargs.items())))
     detector = PanelDetector(objname, orig_img, **kwargs)
-    return detector.run()
+
+    previous = previous_panels.get(key)
+    if previous is not None:
+        previous_panels.move_to_end(key)
+
+    root = None
+    persistent = environment.panel_layouts and previous is None
+    if persistent:
+        data = layouts.restore(orig_img)
+        root = None if data is None else load_layout(detector, data)
+    if root is None:
+        root = detector.run_incremental(previous)
+        if persistent:
+            layouts.save(orig_img, root)
+
+    previous_panels[key] = (np.copy(orig_img.gray()), root)
+    if len(previous_panels) > PANEL_HISTORY_SIZE:
+        previous_panels.popitem(last=False)
+    return root
 
 def detect_panels2(objname, orig_img, *, maxlinediff=0.1, minheight=24, mingap=5):
     w, h = orig_img.width, orig_img.height
@@ -677,7 +840,7 @@ def detect_panels2(objname, orig_img, *, maxlinediff=0.1, minheight=24, mingap=5
 
     if istest():
         for group in hgroups:
-            buf = orig_img.clone().buf
+            buf = clone_frame(orig_img)
             indexes = '-'.join(map(str, group))
             rect = group.rect(hlines)
             if rect.height < minheight:
@@ -688,7 +851,7 @@ def detect_panels2(objname, orig_img, *, maxlinediff=0.1, minheight=24, mingap=5
             imdebug(f'hgroup-{indexes}', buf)
 
         for group in vgroups:
-            buf = orig_img.clone().buf
+            buf = clone_frame(orig_img)
             indexes = '-'.join(map(str, group))
             rect = group.rect(vlines)
             if rect.height < minheight:
@@ -701,14 +864,17 @@ def detect_panels2(objname, orig_img, *, maxlinediff=0.1, minheight=24, mingap=5
     log.notice(f"H-Groups: {len(hgroups)}")
     log.notice(f"V-Groups: {len(vgroups)}")
 
+    hrects = [ group.rect(hlines) for group in hgroups ]
+    vrects = [ group.rect(vlines) for group in vgroups ]
+
     qpanels, panel_rects = 0, []
-    for i, hgroup in enumerate(hgroups):
+    for i, _ in enumerate(hgroups):
         for j, vgroup in enumerate(vgroups):
             if vgroup is None:
                 continue
 
-            ri = hgroup.rect(hlines)
-            rj = vgroup.rect(vlines)
+            ri = hrects[i]
+            rj = vrects[j]
 
             x1 = max(ri.x1, rj.x1)
             y1 = max(ri.y1, rj.y1)
@@ -738,7 +904,7 @@ def detect_panels2(objname, orig_img, *, maxlinediff=0.1, minheight=24, mingap=5
             panel_rects.append(outer)
 
     if istest():
-        buf = orig_img.clone().buf
+        buf = clone_frame(orig_img)
         for rect in panel_rects:
             x1, y1, x2, y2 = rect
             cv2.rectangle(buf, (x1, y1), (x2, y2), (0, 0, 255), 2)
@@ -746,6 +912,8 @@ def detect_panels2(objname, orig_img, *, maxlinediff=0.1, minheight=24, mingap=5
 
 
 def _init():
-    register('panels', detect_panels)
+    # Panels stay in-process: incremental detection needs the previous tree of the source.
+    # Panel trees keep their frame alive, previous_panels is the only place they are kept.
+    register('panels', detect_panels, cached=False)
 
 _init()
@@ -0,0 +1,134 @@
+import json
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+import log
+from utils import Rect
+
+PANEL_LAYOUTS_DN = Path.home() / 'data' / 'qazwsx' / 'panels'
+LAYOUT_MAX_DISTANCE = 6
+LAYOUT_EDGE_MARGIN = 2
+LAYOUT_EDGE_RATIO = 0.6
+LAYOUT_EDGE_CONTRAST = 16
+
+def get_fingerprint(gray):
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:,1:] > small[:,:-1]).flatten()
+    return int(''.join('1' if bit else '0' for bit in bits), 2)
+
+def dump_layout(panel):
+    return {
+        'rect': list(map(int, panel.rect)),
+        'children': [ dump_layout(child) for child in panel.children ],
+    }
+
+def get_layout_rects(data):
+    yield Rect(*data['rect'])
+    for child in data['children']:
+        yield from get_layout_rects(child)
+
+def has_edge(gray, x1, y1, x2, y2): #pylint: disable=too-many-arguments
+    m = LAYOUT_EDGE_MARGIN
+    h, w = gray.shape
+    if y1 == y2:
+        band = gray[max(y1-m, 0):min(y1+m+1, h),max(x1, 0):min(x2, w)]
+        axis = 0
+    else:
+        band = gray[max(y1, 0):min(y2, h),max(x1-m, 0):min(x1+m+1, w)]
+        axis = 1
+
+    if band.shape[axis] < 2 or band.size == 0:
+        return False
+    contrast = np.abs(np.diff(band.astype(np.int16), axis=axis)).max(axis=axis)
+    return (contrast >= LAYOUT_EDGE_CONTRAST).mean() >= LAYOUT_EDGE_RATIO
+
+class PanelLayouts:
+    def __init__(self, dn=PANEL_LAYOUTS_DN):
+        self.dn = Path(dn)
+        self.known = None
+
+    def load(self):
+        self.known = {}
+        for fn in sorted(self.dn.glob('*.json')):
+            resolution, sfingerprint = fn.stem.rsplit('-', 1)
+            self.known.setdefault(resolution, []).append((int(sfingerprint, 16), fn))
+
+    def find(self, resolution, fingerprint):
+        if self.known is None:
+            self.load()
+
+        best_fn, best_distance = None, LAYOUT_MAX_DISTANCE + 1
+        for known, fn in self.known.get(resolution, []):
+            distance = bin(known ^ fingerprint).count('1')
+            if distance < best_distance:
+                best_fn, best_distance = fn, distance
+        return best_fn
+
+    @staticmethod
+    def is_valid(img, data):
+        gray = img.gray()
+        ox, oy = img.rect.x1, img.rect.y1
+        bounds = Rect(*data['rect']).move(-ox, -oy)
+
+        # Frame edges prove nothing, the layout needs at least one interior border
+        qborders = 0
+        for rect in get_layout_rects(data):
+            x1, y1, x2, y2 = rect.move(-ox, -oy)
+            for border in ((x1, y1, x2, y1), (x1, y2, x2, y2), (x1, y1, x1, y2), (x2, y1, x2, y2)):
+                bx1, by1, bx2, by2 = border
+                if bx1 == bx2 and bx1 in (bounds.x1, bounds.x2):
+                    continue
+                if by1 == by2 and by1 in (bounds.y1, bounds.y2):
+                    continue
+                if not has_edge(gray, *border):
+                    return False
+                qborders += 1
+        return qborders > 0
+
+    def restore(self, img):
+        resolution = f'{img.width}x{img.height}'
+        fn = self.find(resolution, get_fingerprint(img.gray()))
+        if fn is None:
+            return None
+
+        try:
+            with open(fn, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            log.warn(f"Cannot load panel layout {fn}: {e}")
+            return None
+
+        if Rect(*data['rect']) != img.rect or not self.is_valid(img, data):
+            log.info(f"Panel layout {fn.name} does not match the frame")
+            return None
+
+        log.info(f"Panel layout restored from {fn.name}")
+        return data
+
+    def save(self, img, root):
+        if not root.children:
+            return
+        if self.known is None:
+            self.load()
+
+        resolution = f'{img.width}x{img.height}'
+        fingerprint = get_fingerprint(img.gray())
+        fn = self.find(resolution, fingerprint)
+        stale = fn is not None
+        if not stale:
+            fn = self.dn / f'{resolution}-{fingerprint:016x}.json'
+
+        try:
+            self.dn.mkdir(parents=True, exist_ok=True)
+            with open(fn, 'w', encoding='utf-8') as f:
+                json.dump(dump_layout(root), f)
+        except OSError as e:
+            log.warn(f"Cannot save panel layout {fn}: {e}")
+            return
+
+        if not stale:
+            self.known.setdefault(resolution, []).append((fingerprint, fn))
+
+layouts = PanelLayouts()
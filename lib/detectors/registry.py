@@ -1,37 +1,257 @@
+import json
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from threading import Lock
+from time import time
+
 import log
+import offload
 from environment import environment
+from imgrect import ImgRect, get_nbytes, roi_hash
 from utils import fail
 
-class Detectors:
-    def __init__(self):
+RESULT_CACHE_SIZE = 256
+RESULT_CACHE_BYTES = 16 * 1024 * 1024
+DETECTOR_STATS_FN = Path.home() / 'data' / 'qazwsx' / 'detectors.json'
+DETECT_MODES = ('priority', 'adaptive', 'parallel')
+DETECT_WORKERS = 4
+
+def normalize(value):
+    if isinstance(value, dict):
+        return tuple(sorted((key, normalize(item)) for key, item in value.items()))
+    if isinstance(value, (tuple, list)):
+        return tuple(normalize(item) for item in value)
+    try:
+        hash(value)
+    except TypeError:
+        return repr(value)
+    return value
+
+def get_result_key(objname, method, args, kwargs):
+    if not args or not isinstance(args[0], ImgRect):
+        return None
+
+    img, *args = args
+    return (objname, method.__name__, tuple(img.rect), roi_hash(img),
+        normalize(args), normalize(kwargs))
+
+class DetectorStats:
+    def __init__(self, runs=0, successes=0, total_sec=0.0):
+        self.runs = runs
+        self.successes = successes
+        self.total_sec = total_sec
+
+    def add(self, duration, success):
+        self.runs += 1
+        self.successes += int(success)
+        self.total_sec += duration
+
+    @property
+    def expected_cost(self):
+        if self.runs == 0:
+            return 0.0
+        mean_sec = self.total_sec / self.runs
+        probability = (self.successes + 1) / (self.runs + 2)
+        return mean_sec / probability
+
+    def dump(self):
+        return {
+            'runs': self.runs,
+            'successes': self.successes,
+            'total_sec': round(self.total_sec, 6),
+        }
+
+class Detectors: #pylint: disable=too-many-instance-attributes
+    def __init__(self, cache_size=RESULT_CACHE_SIZE, cache_bytes=RESULT_CACHE_BYTES,
+            stats_fn=DETECTOR_STATS_FN):
         self.known = {}
+        self.uncached = set()
+        self.offloaded = set()
+        self.results = OrderedDict()
+        self.cache_size = cache_size
+        self.cache_bytes = cache_bytes
+        self.nbytes = 0
+        self.stats = Counter()
+        self.stats_fn = Path(stats_fn)
+        self.timings = {}
+        self.lock = Lock()
+        self.pool = None
+        self.processes = None
+        self.load_timings()
+
+    def load_timings(self):
+        if not self.stats_fn.is_file():
+            return
+
+        try:
+            with open(self.stats_fn, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            log.warn(f"Cannot load detector stats from {self.stats_fn}: {e}")
+            return
+
+        for objname, methods in data.items():
+            for name, values in methods.items():
+                self.timings[objname, name] = DetectorStats(**values)
+
+    def save_timings(self):
+        if not self.timings:
+            return
+
+        data = {}
+        for (objname, name), timing in sorted(self.timings.items()):
+            data.setdefault(objname, {})[name] = timing.dump()
+
+        try:
+            self.stats_fn.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.stats_fn, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=2)
+        except OSError as e:
+            log.warn(f"Cannot save detector stats to {self.stats_fn}: {e}")
+
+    def get_timing(self, objname, method):
+        key = objname, method.__name__
+        result = self.timings.get(key)
+        if result is None:
+            result = DetectorStats()
+            self.timings[key] = result
+        return result
+
+    def execute(self, objname, method, *args, **kwargs):
+        qprocesses = environment.detect_processes
+        if qprocesses <= 0 or method not in self.offloaded:
+            return method(objname, *args, **kwargs)
+        if not args or not isinstance(args[0], ImgRect):
+            return method(objname, *args, **kwargs)
+
+        with self.lock:
+            if self.processes is None:
+                self.processes = offload.OffloadPool(qprocesses)
+            processes = self.processes
+
+        return processes.run(method, objname, *args, **kwargs)
+
+    def measure(self, objname, method, *args, **kwargs):
+        start = time()
+        result = self.execute(objname, method, *args, **kwargs)
+        with self.lock:
+            self.get_timing(objname, method).add(time() - start, result is not None)
+        return result
+
+    def get_candidates(self, objname):
+        candidates = [ method for _, method in self.known.get(objname, []) ]
+        if environment.detect_mode != 'adaptive':
+            return candidates
+
+        return sorted(candidates, key=lambda method: self.get_timing(objname, method).expected_cost)
+
+    def call(self, objname, method, *args, **kwargs):
+        key = None
+        if method not in self.uncached:
+            key = get_result_key(objname, method, args, kwargs)
+        if key is None:
+            return self.measure(objname, method, *args, **kwargs)
+
+        # Cached results are shared between callers, treat them as read-only.
+        # Detectors that return objects meant to be modified or objects that keep
+        # the frame alive opt out with cached=False.
+        with self.lock:
+            entry = self.results.get(key)
+            if entry is not None:
+                self.results.move_to_end(key)
+                self.stats[objname, 'hits'] += 1
+                return entry[0]
+            self.stats[objname, 'misses'] += 1
+
+        result = self.measure(objname, method, *args, **kwargs)
+        nbytes = get_nbytes(result)
+        with self.lock:
+            if key not in self.results:
+                self.results[key] = (result, nbytes)
+                self.nbytes += nbytes
+
+            while self.results and (len(self.results) > self.cache_size
+                    or self.nbytes > self.cache_bytes):
+                _, (_, evicted) = self.results.popitem(last=False)
+                self.nbytes -= evicted
+        return result
+
+    def run_parallel(self, objname, candidates, *args, **kwargs):
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=DETECT_WORKERS,
+                thread_name_prefix='detector')
+
+        futures = [ self.pool.submit(self.call, objname, method, *args, **kwargs)
+            for method in candidates ]
+
+        try:
+            for future in futures:
+                result = future.result()
+                if result is not None:
+                    return result
+        finally:
+            for future in futures:
+                future.cancel()
+        return None
 
     def run(self, objname, *args, **kwargs):
-        candidates = self.known.get(objname, [])
-        for _, entry in candidates:
-            result = entry(objname, *args, **kwargs)
+        if environment.detect_mode == 'parallel':
+            candidates = [ method for _, method in self.known.get(objname, []) ]
+            if len(candidates) > 1:
+                return self.run_parallel(objname, candidates, *args, **kwargs)
+
+        for method in self.get_candidates(objname):
+            result = self.call(objname, method, *args, **kwargs)
             if result is not None:
                 return result
         return None
 
-    def register(self, objname, method, priority):
+    def register(self, objname, method, priority, cached=True, offloaded=False):
         lst = self.known.get(objname)
         if lst is None:
             lst = []
             self.known[objname] = lst
 
         lst.append((priority, method))
-        lst.sort(reverse=True)
+        lst.sort(key=lambda item: item[0], reverse=True)
+
+        if not cached:
+            self.uncached.add(method)
+        if offloaded:
+            self.offloaded.add(method)
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+            self.nbytes = 0
 
-def register(objname, method, priority=10):
+    def deinit(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+        if self.processes is not None:
+            self.processes.shutdown(wait=False, cancel_futures=True)
+            self.processes = None
+
+        for objname in sorted({ objname for objname, _ in self.stats }):
+            hits, misses = self.stats[objname, 'hits'], self.stats[objname, 'misses']
+            log.info(f"Detector cache for {objname}: {hits} hits, {misses} misses")
+        self.save_timings()
+
+def register(objname, method, priority=10, *, cached=True, offloaded=False):
     detectors = environment.components.detectors
     if detectors is None:
         fail(f"Cannot register detector: {objname}")
 
-    detectors.register(objname, method, priority)
+    detectors.register(objname, method, priority, cached, offloaded)
     log.notice(f"Registered detector for {objname}/{priority}: {method.__name__}")
 
 def _init():
+    if environment.detect_mode not in DETECT_MODES:
+        fail(f"Invalid detect_mode: {environment.detect_mode}")
+
     detectors = Detectors()
     environment.components.detectors = detectors
 
@@ -8,6 +8,7 @@ components.video = None
 components.ocr = None
 components.effector = None
 components.detectors = None
+components.labels = None
 
 resolution = EasyDict()
 resolution.width = 1920
@@ -22,6 +23,10 @@ environment.started_at = time()
 environment.start_pause = 10
 environment.time_scale = 1.0
 environment.fps = 10
+environment.detect_mode = 'priority'
+environment.detect_processes = 0
+environment.panel_layouts = False
+environment.ocr_urls = None
 environment.vm = None
 environment.ready = False
 environment.basta = False
@@ -1,19 +1,171 @@
+from collections import OrderedDict, namedtuple
+from hashlib import blake2b
+from threading import Lock
+
 import cv2
 import numpy as np
 
 import log
 from environment import environment
-from utils import Rect, badarg, fail
+from timer import age, wait
+from utils import Rect, badarg, fail, nice
+
+BAD_OCR = 'FAILED'
+DERIVED_CACHE_BYTES = 64 * 1024 * 1024
+LSD_PYRAMID_MINLENGTH = 10
+LSD_PYRAMID_MAXANGLE = 5
+
+LabelItemTuple = namedtuple('LabelItemTuple', ['rect', 'text', 'probability'])
+
+class LabelItem(LabelItemTuple):
+    @property
+    def x(self):
+        return self.rect.cx
+
+    @property
+    def y(self):
+        return self.rect.cy
+
+    @staticmethod
+    def from_ocr(item):
+        if item is None:
+            return None
+        return LabelItem(item.rect, item.text, float(item.probability))
+
+def get_nbytes(value):
+    if isinstance(value, (tuple, list)):
+        return sum(get_nbytes(item) for item in value)
+    return getattr(value, 'nbytes', 0)
+
+def freeze(value):
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    elif isinstance(value, tuple):
+        for item in value:
+            freeze(item)
+    return value
+
+class DerivedCache:
+    def __init__(self, limit=DERIVED_CACHE_BYTES):
+        self.limit = limit
+        self.nbytes = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def peek(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def get(self, key, func):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        value = freeze(func())
+        nbytes = get_nbytes(value)
+
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = (value, nbytes)
+                self.nbytes += nbytes
 
-class ImgRect:
+            while self.nbytes > self.limit and len(self.entries) > 1:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.nbytes -= evicted
+
+        return value
+
+def _gray(img):
+    data = img.data
+    if len(data.shape) == 2:
+        return np.copy(data)
+    return cv2.cvtColor(data, cv2.COLOR_BGR2GRAY)
+
+def _adaptive_threshold(img, block_size, c):
+    return cv2.adaptiveThreshold(img.gray(), 255,
+        cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, block_size, c)
+
+def _inverted_threshold(img, block_size, c):
+    return 255 - img.adaptive_threshold(block_size, c)
+
+def _blur(img, ksize):
+    return cv2.GaussianBlur(img.gray(), ksize, 0)
+
+def _canny(img, threshold1, threshold2, ksize):
+    return cv2.Canny(img.blur(ksize), threshold1, threshold2)
+
+def _lsd(img):
+    lsd = cv2.createLineSegmentDetector(0)
+    return tuple(lsd.detect(img.gray()))
+
+def _lsd_pyramid(img, factor, minlength):
+    gray = img.gray()
+    h, w = gray.shape
+    small = cv2.resize(gray, (w // factor, h // factor), interpolation=cv2.INTER_AREA)
+
+    lsd = cv2.createLineSegmentDetector(0)
+    coarse = lsd.detect(small)[0]
+    if coarse is None:
+        return None, None, None, None
+
+    margin = 2 * factor + 2
+    maxslope = np.tan(np.radians(LSD_PYRAMID_MAXANGLE))
+    seen = set()
+    parts = ([], [], [], [])
+    for cx1, cy1, cx2, cy2 in coarse[:,0] * factor:
+        dx, dy = abs(cx2 - cx1), abs(cy2 - cy1)
+        if 2 * max(dx, dy) < minlength or min(dx, dy) > maxslope * max(dx, dy):
+            continue
+
+        x1, x2 = max(int(min(cx1, cx2)) - margin, 0), min(int(max(cx1, cx2)) + margin + 1, w)
+        y1, y2 = max(int(min(cy1, cy2)) - margin, 0), min(int(max(cy1, cy2)) + margin + 1, h)
+        lines, *tail = lsd.detect(np.ascontiguousarray(gray[y1:y2,x1:x2]))
+        if lines is None:
+            continue
+
+        lines = lines + np.array([x1, y1, x1, y1], dtype=lines.dtype)
+        for i, (lx1, ly1, lx2, ly2) in enumerate(lines[:,0]):
+            ldx, ldy = abs(lx2 - lx1), abs(ly2 - ly1)
+            if min(ldx, ldy) > maxslope * max(ldx, ldy):
+                continue
+
+            key = (round(lx1 / 2), round(ly1 / 2), round(lx2 / 2), round(ly2 / 2))
+            if key in seen:
+                continue
+            seen.add(key)
+
+            parts[0].append(lines[i])
+            for part, values in zip(parts[1:], tail):
+                if values is not None:
+                    part.append(values[i])
+
+    if not parts[0]:
+        return None, None, None, None
+    return tuple(np.array(part) if part else None for part in parts)
+
+class ImgRect: #pylint: disable=too-many-public-methods
     def __init__(self, buf, *, parent=None, rect=None):
         dim = len(buf.shape)
         if dim not in (2, 3):
             badarg(f"Invalid buf: wrong shape {buf.shape}")
 
         self._ocr = None
+        self._cache = None
         self.buf = buf if dim == 2 else buf[:,:,:3]
         self.parent = parent
+        self.ocr_rects = []
+        self.planned_ocr = []
 
         if rect is None:
             self.rect = self.get_buf_rect()
@@ -36,33 +188,59 @@ class ImgRect:
 
     @property
     def has_ocr(self):
-        return self._ocr is not None
+        return self._ocr is not None and self._ocr is not BAD_OCR
+
+    @property
+    def root(self):
+        return self if self.parent is None else self.parent
+
+    def plan_ocr(self, rects):
+        self.root.planned_ocr = [ Rect(*rect) for rect in rects ]
+
+    def prefers_shared_ocr(self, rect, ocr_component):
+        # Rects recognized earlier are sunk cost, only the current and planned requests count
+        pending = [ r for r in self.planned_ocr if r not in self.ocr_rects ]
+        if rect not in pending:
+            pending.append(rect)
+
+        separate = ocr_component.estimate_cost(pending)
+        shared = ocr_component.estimate_cost([self.rect])
+        log.debug(f"OCR cost: {len(pending)} subrects {separate:.2f} sec, shared {shared:.2f} sec")
+        return shared < separate
 
     def get_ocr(self):
+        ocr_component = environment.components.ocr
         parent = self.parent
         if parent is not None:
             if parent.has_ocr:
                 return parent.ocr.in_rect(self.rect)
 
-        ocr_component = environment.components.ocr
+            shared = ocr_component is not None
+            shared = shared and parent.prefers_shared_ocr(self.rect, ocr_component)
+            if shared and parent.ocr is not None:
+                log.info(f"Derive OCR for {self.rect} from the parent frame")
+                return parent.ocr.in_rect(self.rect)
+
         if ocr_component is None:
             return None
 
-        return ocr_component.recognize(self, self.rect)
+        result = ocr_component.recognize(self, self.rect)
+        if parent is not None:
+            parent.ocr_rects.append(self.rect)
+        return result
 
     @property
     def ocr(self):
-        bad_ocr = 'FAILED'
+        if self._ocr is BAD_OCR:
+            return None
+
         if self._ocr is not None:
             return self._ocr
 
-        if self._ocr == bad_ocr:
-            return None
-
         self._ocr = self.get_ocr()
         if self._ocr is None:
             log.error("Failed to get an OCR in imgrect")
-            self._ocr = bad_ocr
+            self._ocr = BAD_OCR
             return None
 
         return self._ocr
@@ -98,19 +276,60 @@ class ImgRect:
         return ImgRect(self.buf, parent=parent, rect=rect)
 
     def clone(self):
-        x1, y1, x2, y2 = self.rect
-        if len(self.buf.shape) == 2:
-            region = np.copy(self.buf[y1:y2,x1:x2])
-        else:
-            region = np.copy(self.buf[y1:y2,x1:x2,:])
+        return ImgRect(np.copy(self.data))
+
+    @property
+    def cache(self):
+        root = self.root
+        if root._cache is None: #pylint: disable=protected-access
+            root._cache = DerivedCache() #pylint: disable=protected-access
+        return root._cache #pylint: disable=protected-access
 
-        return ImgRect(np.copy(region))
+    def derive(self, op, func, *params, pointwise=False):
+        cache = self.cache
+        buf_rect = self.get_buf_rect()
+        full_key = (op, params, buf_rect)
+        if self.rect == buf_rect:
+            return cache.get(full_key, lambda: func(self, *params))
+
+        full = cache.peek(full_key) if pointwise else None
+        if full is not None:
+            x1, y1, x2, y2 = self.rect
+            return full[y1:y2,x1:x2]
+
+        return cache.get((op, params, self.rect), lambda: func(self, *params))
+
+    def gray(self):
+        return self.derive('gray', _gray, pointwise=True)
+
+    def adaptive_threshold(self, block_size=11, c=2, *, inverted=False):
+        if inverted:
+            return self.derive('inverted_threshold', _inverted_threshold, block_size, c)
+        return self.derive('adaptive_threshold', _adaptive_threshold, block_size, c)
+
+    def blur(self, ksize=(9, 9)):
+        return self.derive('blur', _blur, ksize)
+
+    def canny(self, threshold1=50, threshold2=150, *, ksize=(9, 9)):
+        return self.derive('canny', _canny, threshold1, threshold2, ksize)
+
+    def lsd(self, pyramid=1, minlength=LSD_PYRAMID_MINLENGTH):
+        if pyramid <= 1:
+            return self.derive('lsd', _lsd)
+        return self.derive('lsd_pyramid', _lsd_pyramid, pyramid, minlength)
 
     def make_gray(self):
-        if len(self.buf.shape) == 2:
-            return self.clone()
-        buf = self.buf[:,:,:3]
-        return ImgRect(cv2.cvtColor(buf, cv2.COLOR_BGR2GRAY))
+        return ImgRect(np.copy(self.gray()))
+
+    def find_label(self, label, *, key='top', reverse=False, **kwargs):
+        labels = environment.components.labels
+        if labels is not None:
+            return labels.find(self, label, key=key, reverse=reverse, **kwargs)
+
+        ocr = self.ocr
+        if ocr is None:
+            return None
+        return LabelItem.from_ocr(ocr.match(label).best(key, reverse))
 
     def detect(self, objname, *args, **kwargs):
         detectors = environment.components.detectors
@@ -121,3 +340,37 @@ class ImgRect:
 
 def get_frame(rect=None):
     return ImgRect(environment.frame_data, rect=rect)
+
+def roi_hash(img):
+    return blake2b(np.ascontiguousarray(img.data), digest_size=16).digest()
+
+def wait_for_text(rect, pattern, timeout, *, key='top', delay=0.2):
+    last_call = age() + timeout
+    last_frame, last_hash = None, None
+    qrequests = 0
+
+    while True:
+        frame = environment.frame_data
+        if frame is not None and frame is not last_frame:
+            last_frame = frame
+            img = ImgRect(frame, rect=rect)
+            digest = roi_hash(img)
+            if digest != last_hash:
+                last_hash = digest
+                qrequests += 1
+                ocr = img.ocr
+                if ocr is None:
+                    last_hash = None
+                else:
+                    found = ocr.match(pattern).best(key)
+                    if found is not None:
+                        spattern = nice(pattern)
+                        log.info(f"wait_for_text: found {spattern} after {qrequests} OCR requests")
+                        return found
+
+        if age() >= last_call:
+            spattern = nice(pattern)
+            log.info(f"wait_for_text: no {spattern} in {timeout} sec, {qrequests} OCR requests")
+            return None
+
+        wait(delay, β=None)
@@ -0,0 +1,112 @@
+import pickle
+from threading import Lock
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from environment import environment
+from utils import GlobalFailure
+
+class WorkerLogger:
+    def trace(self, text):
+        pass
+
+    def debug(self, text):
+        pass
+
+    def info(self, text):
+        pass
+
+    def notice(self, text):
+        pass
+
+    def warn(self, text):
+        print(f"Worker warning: {text}", flush=True)
+
+    def error(self, text):
+        print(f"Worker error: {text}", flush=True)
+
+    def panic(self, text):
+        self.error(text)
+        raise GlobalFailure(text)
+
+    def user(self, text):
+        pass
+
+    def shift(self, delta):
+        pass
+
+    def screenshot(self, fn, img, rect):
+        pass
+
+def init_worker():
+    environment.components.logger = WorkerLogger()
+    environment.test = None
+    environment.detect_processes = 0
+
+attached = {}
+
+def attach(name):
+    shm = attached.get(name)
+    if shm is None:
+        shm = SharedMemory(name=name)
+        attached[name] = shm
+    return shm
+
+def run_shared(method, objname, name, shape, dtype, rect, args, kwargs): #pylint: disable=too-many-arguments
+    from imgrect import ImgRect #pylint: disable=import-outside-toplevel
+
+    buf = np.ndarray(shape, dtype=dtype, buffer=attach(name).buf)
+    result = method(objname, ImgRect(buf, rect=rect), *args, **kwargs)
+    return pickle.dumps(result)
+
+class OffloadPool:
+    def __init__(self, qprocesses):
+        self.executor = ProcessPoolExecutor(max_workers=qprocesses,
+            mp_context=get_context('spawn'), initializer=init_worker)
+        self.segments = []
+        self.free = []
+        self.lock = Lock()
+
+    def acquire(self, nbytes):
+        with self.lock:
+            for shm in self.free:
+                if shm.size >= nbytes:
+                    self.free.remove(shm)
+                    return shm
+
+            shm = SharedMemory(create=True, size=max(nbytes, 1))
+            self.segments.append(shm)
+            return shm
+
+    def release(self, shm):
+        with self.lock:
+            self.free.append(shm)
+
+    def run(self, method, objname, img, *args, **kwargs):
+        # Segments are reused between calls and only the ROI is copied, so the
+        # worker sees the frame layout and keeps frame coordinates
+        buf = img.buf
+        shm = self.acquire(buf.nbytes)
+        try:
+            shared = np.ndarray(buf.shape, dtype=buf.dtype, buffer=shm.buf)
+            x1, y1, x2, y2 = img.rect
+            shared[y1:y2,x1:x2] = buf[y1:y2,x1:x2]
+            del shared
+
+            future = self.executor.submit(run_shared, method, objname, shm.name,
+                buf.shape, buf.dtype.str, img.rect, args, kwargs)
+            return pickle.loads(future.result())
+        finally:
+            self.release(shm)
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        self.executor.shutdown(wait=wait, cancel_futures=cancel_futures)
+        with self.lock:
+            for shm in self.segments:
+                shm.close()
+                shm.unlink()
+            self.segments.clear()
+            self.free.clear()
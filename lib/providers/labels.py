@@ -0,0 +1,139 @@
+import re
+from collections import Counter
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+import log
+from environment import environment
+from imgrect import LabelItem
+from providers.ocr import to_lambda
+from utils import Rect
+
+LABELS_DN = Path.home() / 'data' / 'qazwsx' / 'labels'
+MATCH_THRESHOLD = 0.9
+MIN_TEMPLATE_STD = 8.0
+MAX_OVERLAP = 0.3
+MAX_LOCATIONS = 256
+
+def label_key(label):
+    return re.sub(r'[^a-z0-9]+', '_', label.lower()).strip('_')
+
+def get_overlap(r1, r2):
+    x1, y1 = max(r1.x1, r2.x1), max(r1.y1, r2.y1)
+    x2, y2 = min(r1.x2, r2.x2), min(r1.y2, r2.y2)
+    if x1 >= x2 or y1 >= y2:
+        return 0.0
+    inner = (x2 - x1) * (y2 - y1)
+    return inner / (r1.area + r2.area - inner)
+
+def suppress(items):
+    result = []
+    for item in sorted(items, key=lambda item: item.probability, reverse=True):
+        if all(get_overlap(item.rect, kept.rect) <= MAX_OVERLAP for kept in result):
+            result.append(item)
+    return result
+
+def to_gray(buf):
+    if len(buf.shape) == 2:
+        return buf
+    return cv2.cvtColor(buf[:,:,:3], cv2.COLOR_BGR2GRAY)
+
+
+class LabelFinder:
+    def __init__(self, dn=LABELS_DN):
+        self.dn = Path(dn)
+        self.templates = {}
+        self.stats = Counter()
+
+    def get_templates(self, label):
+        key = label_key(label)
+        result = self.templates.get(key)
+        if result is not None:
+            return result
+
+        result = []
+        for fn in sorted((self.dn / key).glob('*.png')):
+            template = cv2.imread(str(fn), cv2.IMREAD_GRAYSCALE)
+            if template is not None:
+                result.append((fn.stem, template))
+
+        self.templates[key] = result
+        return result
+
+    def match_all(self, img, label, threshold=MATCH_THRESHOLD):
+        gray = img.gray()
+        found = []
+        for scale, template in self.get_templates(label):
+            th, tw = template.shape
+            if th > gray.shape[0] or tw > gray.shape[1]:
+                continue
+
+            result = cv2.matchTemplate(gray, template, cv2.TM_CCOEFF_NORMED)
+            result[~np.isfinite(result)] = -1.0
+            ys, xs = np.nonzero(result >= threshold)
+            if len(xs) > MAX_LOCATIONS:
+                top = np.argpartition(-result[ys, xs], MAX_LOCATIONS)[:MAX_LOCATIONS]
+                ys, xs = ys[top], xs[top]
+
+            for x, y in zip(xs.tolist(), ys.tolist()):
+                x1, y1 = img.rect.x1 + x, img.rect.y1 + y
+                rect = Rect(x1, y1, x1 + tw, y1 + th)
+                found.append(LabelItem(rect, label, float(result[y, x])))
+            if len(xs) > 0:
+                log.debug(f"Label {label}: template {scale} matched at {len(xs)} locations")
+
+        return suppress(found)
+
+    def match(self, img, label, *, key='top', reverse=False, threshold=MATCH_THRESHOLD):
+        found = self.match_all(img, label, threshold)
+        if not found:
+            return None
+
+        select = max if reverse else min
+        return select(found, key=to_lambda(key))
+
+    def learn(self, img, label, item):
+        x1, y1, x2, y2 = item.rect
+        template = to_gray(img.buf[y1:y2,x1:x2])
+        if template.size == 0 or float(np.std(template)) < MIN_TEMPLATE_STD:
+            return
+
+        scale = f'h{y2 - y1:03d}'
+        templates = self.get_templates(label)
+        if any(known == scale for known, _ in templates):
+            return
+
+        dn = self.dn / label_key(label)
+        dn.mkdir(parents=True, exist_ok=True)
+        fn = dn / f'{scale}.png'
+        cv2.imwrite(str(fn), template)
+        templates.append((scale, np.copy(template)))
+        log.info(f"Learned template for label {label}: {fn}")
+
+    def find(self, img, label, *, key='top', reverse=False, threshold=MATCH_THRESHOLD):
+        found = self.match(img, label, key=key, reverse=reverse, threshold=threshold)
+        if found is not None:
+            self.stats['hits'] += 1
+            return found
+
+        self.stats['misses'] += 1
+        ocr = img.ocr
+        if ocr is None:
+            return None
+
+        item = LabelItem.from_ocr(ocr.match(label).best(key, reverse))
+        if item is not None:
+            self.learn(img, label, item)
+        return item
+
+    def deinit(self):
+        hits, misses = self.stats['hits'], self.stats['misses']
+        log.info(f"Label templates: {hits} hits, {misses} misses")
+
+def _init():
+    labels = LabelFinder()
+    environment.components.labels = labels
+
+_init()
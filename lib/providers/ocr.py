@@ -1,6 +1,11 @@
 import re
-from collections import namedtuple
+from collections import Counter, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait as wait_futures
+from functools import cached_property
 from pathlib import Path
+from threading import Lock
+from time import time, sleep
+from urllib.parse import urlparse
 
 import numpy as np
 from requests import get as http_request
@@ -8,21 +13,56 @@ from requests import get as http_request
 import log
 from environment import environment
 from timer import age
-from utils import badarg, Rect
+from utils import badarg, fail, Rect
 
 
 OCR_SERVER_URL = 'http://localhost:1914/test'
+OCR_SERVER_URLS = [ OCR_SERVER_URL ]
+
+HEALTH_INTERVAL = 10.0
+HEALTH_TIMEOUT = 1.0
+LATENCY_WINDOW = 100
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 10
+
+OCR_PRIORITY = 10
+BUSY_BACKOFF = 0.5
+
+# Rough cost model of one OCR request in seconds: a fixed part (HTTP round trip, file
+# write, text detection warm-up) plus a part proportional to the ROI area, about 0.4 sec
+# for a 1920x1080 frame. Estimates, recalibrate them with ocr_bench.py on the target GPU.
+OCR_REQUEST_COST = 0.3
+OCR_PIXEL_COST = 2.0e-7
+
+GRID_CELL = 64
+GRID_MIN_ITEMS = 32
+
+FUZZY_MIN_SCORE = 0.5
+
+OCR_COLUMNS = ('x1', 'y1', 'x2', 'y2', 'cx', 'cy', 'prob')
+X1, Y1, X2, Y2, CX, CY, PROB = range(len(OCR_COLUMNS))
 
 
 TEXT_KEYS = {
     'x': lambda t: t.x,
     'y': lambda t: t.y,
-    'left': lambda t: t.lx,
-    'right': lambda t: t.rx,
-    'top': lambda t: t.ty,
-    'bottom': lambda t: t.by,
-    'height': lambda t: t.by - t.ty,
-    'width': lambda t: t.rx - t.lx,
+    'left': lambda t: t.rect.x1,
+    'right': lambda t: t.rect.x2,
+    'top': lambda t: t.rect.y1,
+    'bottom': lambda t: t.rect.y2,
+    'height': lambda t: t.rect.y2 - t.rect.y1,
+    'width': lambda t: t.rect.x2 - t.rect.x1,
+}
+
+COLUMN_KEYS = {
+    'x': lambda cols: cols[:,CX],
+    'y': lambda cols: cols[:,CY],
+    'left': lambda cols: cols[:,X1],
+    'right': lambda cols: cols[:,X2],
+    'top': lambda cols: cols[:,Y1],
+    'bottom': lambda cols: cols[:,Y2],
+    'height': lambda cols: cols[:,Y2] - cols[:,Y1],
+    'width': lambda cols: cols[:,X2] - cols[:,X1],
 }
 
 def to_lambda(key):
@@ -45,18 +85,92 @@ class OcrItem(OcrItemTuple):
     def height(self):
         return self.rect.x2 - self.rect.x1
 
-    @property
+    @cached_property
     def x(self):
         return sum(elem[0] for elem in self.bbox) // 4
 
-    @property
+    @cached_property
     def y(self):
         return sum(elem[1] for elem in self.bbox) // 4
 
 
+class OcrGrid: #pylint: disable=too-few-public-methods
+    def __init__(self, cols, cell=GRID_CELL):
+        self.cell = cell
+
+        gx = np.floor_divide(cols[:,CX], cell).astype(np.int64)
+        gy = np.floor_divide(cols[:,CY], cell).astype(np.int64)
+        self.gx0, self.gy0 = int(gx.min()), int(gy.min())
+        self.qx = int(gx.max()) - self.gx0 + 1
+        self.qy = int(gy.max()) - self.gy0 + 1
+
+        keys = (gy - self.gy0) * self.qx + (gx - self.gx0)
+        self.order = np.argsort(keys, kind='stable')
+        self.keys = keys[self.order]
+
+    def query(self, x1, y1, x2, y2):
+        cell = self.cell
+        gx1 = max(int(x1 // cell) - self.gx0, 0)
+        gx2 = min(int(x2 // cell) - self.gx0, self.qx - 1)
+        gy1 = max(int(y1 // cell) - self.gy0, 0)
+        gy2 = min(int(y2 // cell) - self.gy0, self.qy - 1)
+        if gx1 > gx2 or gy1 > gy2:
+            return np.empty(0, dtype=np.int64)
+
+        rows = np.arange(gy1, gy2 + 1) * self.qx
+        starts = np.searchsorted(self.keys, rows + gx1, side='left')
+        ends = np.searchsorted(self.keys, rows + gx2, side='right')
+        return np.concatenate([ self.order[s:e] for s, e in zip(starts, ends) ])
+
+
+class OcrEndpoint:
+    def __init__(self, url):
+        self.url = url
+        parsed = urlparse(url)
+        self.stats_url = f"{parsed.scheme}://{parsed.netloc}/stats"
+        self.outstanding = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.healthy = True
+        self.checked_at = None
+
+    def mark_unhealthy(self):
+        self.healthy = False
+        self.checked_at = time()
+
+    def check(self):
+        if self.checked_at is not None and time() - self.checked_at < HEALTH_INTERVAL:
+            return self.healthy
+
+        self.checked_at = time()
+        try:
+            response = http_request(self.stats_url, timeout=HEALTH_TIMEOUT)
+            self.healthy = response.status_code == 200
+        except Exception: #pylint: disable=broad-exception-caught
+            self.healthy = False
+
+        if not self.healthy:
+            log.warn(f"OCR server is unhealthy: {self.url}")
+        return self.healthy
+
+    def percentile(self, q):
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return float(np.percentile(self.latencies, q))
+
+
 class OcrClient():
-    def __init__(self):
+    def __init__(self, urls=None):
         self.qrequests = 0
+        self.endpoints = [ OcrEndpoint(url) for url in (urls or OCR_SERVER_URLS) ]
+        self.lock = Lock()
+        self.pool = None
+        if len(self.endpoints) > 1:
+            self.pool = ThreadPoolExecutor(max_workers=2 * len(self.endpoints))
+
+    def deinit(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
 
     def make_fn(self):
         dn = Path('ocr').absolute()
@@ -67,21 +181,116 @@ class OcrClient():
         self.qrequests += 1
         return fn
 
-    def recognize(self, img, rect, *, lang=None, timeout=60):
+    @staticmethod
+    def estimate_cost(rects):
+        return sum(OCR_REQUEST_COST + OCR_PIXEL_COST * Rect(*rect).area for rect in rects)
+
+    def pick(self, exclude=()):
+        candidates = [ e for e in self.endpoints if e not in exclude ] or self.endpoints
+        if len(self.endpoints) > 1:
+            candidates = [ e for e in candidates if e.check() ] or candidates
+
+        def load(endpoint):
+            latency = endpoint.percentile(50)
+            return endpoint.outstanding, 0.0 if latency is None else latency
+
+        return min(candidates, key=load)
+
+    def call(self, endpoint, params, deadline):
+        params = dict(params)
+        params['deadline'] = f'{deadline:.3f}'
+
+        with self.lock:
+            endpoint.outstanding += 1
+        try:
+            start = time()
+            response = http_request(endpoint.url, params, timeout=max(deadline - time(), 0.1))
+            if response.status_code == 200:
+                endpoint.latencies.append(time() - start)
+            return response
+        except Exception:
+            endpoint.mark_unhealthy()
+            raise
+        finally:
+            with self.lock:
+                endpoint.outstanding -= 1
+
+    def request(self, params, deadline, endpoint=None, exclude=()):
+        delay = BUSY_BACKOFF
+        tried = list(exclude)
+        while True:
+            if endpoint is None:
+                endpoint = self.pick(exclude=tried)
+
+            try:
+                response = self.call(endpoint, params, deadline)
+            except Exception: #pylint: disable=broad-exception-caught
+                tried.append(endpoint)
+                if len(tried) >= len(self.endpoints):
+                    raise
+                log.warn(f"OCR server failed, try another one: {endpoint.url}")
+                endpoint = None
+                continue
+
+            if response.status_code != 503:
+                return response
+
+            tried.append(endpoint)
+            endpoint = None
+            if len(tried) < len(self.endpoints):
+                continue
+
+            if time() + delay >= deadline:
+                log.error(f"OCR servers are busy, give up: {params}")
+                return response
+
+            log.warn(f"OCR servers are busy, retry in {delay:.1f} sec")
+            sleep(delay)
+            delay *= 2
+            tried = []
+
+    def send(self, params, deadline):
+        primary = self.pick()
+        hedge_after = primary.percentile(HEDGE_PERCENTILE)
+        if self.pool is None or hedge_after is None:
+            return self.request(params, deadline, primary)
+
+        first = self.pool.submit(self.request, params, deadline, primary)
+        done, _ = wait_futures([first], timeout=hedge_after)
+        if done:
+            return first.result()
+
+        log.info(f"Hedge OCR request after {hedge_after:.2f} sec on {primary.url}")
+        second = self.pool.submit(self.request, params, deadline, None, [primary])
+
+        response, error = None, None
+        for future in as_completed([first, second]):
+            try:
+                response = future.result()
+            except Exception as e: #pylint: disable=broad-exception-caught
+                error = e
+                continue
+            if response.status_code == 200:
+                return response
+
+        if response is None:
+            raise error
+        return response
+
+    def recognize(self, img, rect, *, lang=None, timeout=60, priority=OCR_PRIORITY):
         fn = self.make_fn()
         img = img.subrect(rect)
         np.save(fn, img.data)
         w, h = img.width, img.height
         log.info(f"ocr.recognize: shape={w}x{h}; rect={rect}; num={self.qrequests};")
 
-        url = OCR_SERVER_URL
-        params = { 'fn': str(fn) }
+        params = { 'fn': str(fn), 'priority': priority }
         if lang:
             params['lang'] = lang
 
         try:
             start = age()
-            response = http_request(url, params, timeout=timeout)
+            response = self.send(params, time() + timeout)
             duration = age() - start
             log.info(f"OCR request for image {w}x{h} finished in {duration:.2f} sec for {params}")
         except Exception as e: #pylint: disable=broad-exception-caught
@@ -90,7 +299,7 @@ class OcrClient():
             return None
 
         if response.status_code != 200:
-            log.error(f"HTTP request failed: {url} with {params}")
+            log.error(f"HTTP request failed: {response.url} with {params}")
             return None
 
         try:
@@ -113,11 +322,60 @@ class OcrClient():
         return ImgOcr(img, raw, rect.x1, rect.y1)
 
 
+def normalize_text(text):
+    return ' '.join(str(text).lower().split())
+
+def trigrams(text):
+    padded = f'  {text} '
+    return { padded[i:i+3] for i in range(len(padded) - 2) }
+
+
+class OcrTextIndex:
+    def __init__(self, items):
+        self.texts = [ normalize_text(item.text) for item in items ]
+        self.grams = [ trigrams(text) for text in self.texts ]
+
+        self.exact = {}
+        for i, text in enumerate(self.texts):
+            self.exact.setdefault(text, []).append(i)
+
+        self.postings = {}
+        for i, grams in enumerate(self.grams):
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(i)
+
+    def find_any(self, texts):
+        result = set()
+        for text in texts:
+            result.update(self.exact.get(normalize_text(text), ()))
+        return sorted(result)
+
+    def fuzzy_any(self, texts, minscore=FUZZY_MIN_SCORE):
+        result = set()
+        for text in texts:
+            grams = trigrams(normalize_text(text))
+            common = Counter()
+            for gram in grams:
+                common.update(self.postings.get(gram, ()))
+
+            for i, q in common.items():
+                score = 2.0 * q / (len(grams) + len(self.grams[i]))
+                if score >= minscore:
+                    result.add(i)
+        return sorted(result)
+
+
 class ImgOcr:
-    def __init__(self, img, raw, dx=0, dy=0):
+    def __init__(self, img, raw, dx=0, dy=0, *, items=None, cols=None, origin=None): #pylint: disable=too-many-arguments
         self.img = img
-        self.raw = raw
-        self.items = [ make_ocr_item(t, dx, dy) for t in raw ]
+        self.origin = origin
+        self.raw = list(raw)
+        if items is None:
+            items = [ make_ocr_item(t, dx, dy) for t in self.raw ]
+        self.items = list(items)
+        self.cols = make_ocr_columns(self.items) if cols is None else cols
+        self._grid = None
+        self._text_index = None
 
     def __iter__(self):
         return iter(self.items)
@@ -126,52 +384,274 @@ class ImgOcr:
     def count(self):
         return len(self.items)
 
+    @property
+    def grid(self):
+        if self._grid is None:
+            self._grid = OcrGrid(self.cols)
+        return self._grid
+
+    @property
+    def text_index(self):
+        if self._text_index is None:
+            self._text_index = OcrTextIndex(self.items)
+        return self._text_index
+
     def create_empty(self):
         return ImgOcr(self.img, [])
 
+    @property
+    def derived(self):
+        return self.origin is not None
+
+    def take(self, indexes):
+        raw, items = self.raw, self.items
+        return ImgOcr(self.img,
+            [ raw[i] for i in indexes ],
+            items=[ items[i] for i in indexes ],
+            cols=self.cols[indexes],
+            origin=self.origin or self,
+        )
+
+    def rect_indexes(self, rect, indexes=None):
+        x1, y1, x2, y2 = rect
+        if indexes is not None:
+            candidates = indexes
+        elif self.count >= GRID_MIN_ITEMS:
+            candidates = np.sort(self.grid.query(x1, y1, x2, y2))
+        else:
+            candidates = np.arange(self.count)
+
+        cx, cy = self.cols[candidates,CX], self.cols[candidates,CY]
+        inside = (x1 <= cx) & (cx <= x2) & (y1 <= cy) & (cy <= y2)
+        return candidates[inside]
+
+    def query(self):
+        return OcrQuery(self)
+
     def filter(self, cond):
-        result = self.create_empty()
-        for t, item in zip(self.raw, self.items):
-            if cond(item):
-                result.raw.append(t)
-                result.items.append(item)
-        return result
+        return self.query().filter(cond)
 
-    def sort(self, key, reverse=False):
-        result = self.create_empty()
-        if self.count == 0:
-            return result
+    def in_rect(self, rect):
+        return self.query().in_rect(rect)
 
-        item_key = to_lambda(key)
-        pairs = zip(self.items, self.raw)
-        pairs = sorted(pairs, key=lambda t: item_key(t[0]), reverse=reverse)
-        result.items, result.raw = zip(*pairs)
-        return result
+    def match(self, m):
+        return self.query().match(m)
+
+    def match_fuzzy(self, text, minscore=FUZZY_MIN_SCORE):
+        return self.query().match_fuzzy(text, minscore)
+
+    def find_any(self, texts, *, minscore=None):
+        return self.query().find_any(texts, minscore=minscore)
+
+    def sort(self, key, reverse=False):
+        return self.query().sort(key, reverse)
 
     def best(self, key, reverse=False):
-        result = self.sort(key, reverse)
-        if result.count == 0:
+        return self.query().best(key, reverse)
+
+    def top(self, key, k, reverse=False):
+        return self.query().top(key, k, reverse)
+
+    def nearest(self, x, y):
+        if self.count == 0:
             return None
-        return result.items[0]
 
-    def _match_regexp(self, pattern):
-        return self.filter(lambda item: bool(pattern.match(item.text)))
+        cols = self.cols
+        d2 = (cols[:,CX] - x) ** 2 + (cols[:,CY] - y) ** 2
+        return self.items[np.argmin(d2)]
+
+
+STEP_COSTS = {
+    'rect': 0,
+    'text': 1,
+    'regexp': 2,
+    'filter': 3,
+}
+
+class OcrQuery: #pylint: disable=too-many-public-methods
+    def __init__(self, source, steps=(), orders=()):
+        self.source = source
+        self.steps = steps
+        self.orders = orders
+        self._indexes = None
+        self._result = None
+
+    def _chain(self, *, step=None, order=None):
+        steps = self.steps if step is None else self.steps + (step,)
+        orders = self.orders if order is None else self.orders + (order,)
+        return OcrQuery(self.source, steps, orders)
 
-    def _match_icase(self, text):
-        text = text.lower()
-        return self.filter(lambda item: item.text.lower() == text)
+    def query(self):
+        return self
+
+    def filter(self, cond):
+        return self._chain(step=('filter', cond))
+
+    def in_rect(self, rect):
+        return self._chain(step=('rect', rect))
 
     def match(self, m):
         if isinstance(m, re.Pattern):
-            return self._match_regexp(m)
-        return self._match_icase(str(m))
+            return self._chain(step=('regexp', m))
+        return self.find_any([str(m)])
 
-    def in_rect(self, rect):
-        if rect is None:
+    def match_fuzzy(self, text, minscore=FUZZY_MIN_SCORE):
+        return self.find_any([text], minscore=minscore)
+
+    def find_any(self, texts, *, minscore=None):
+        return self._chain(step=('text', (tuple(texts), minscore)))
+
+    def sort(self, key, reverse=False):
+        if key not in COLUMN_KEYS:
+            to_lambda(key)
+        return self._chain(order=(key, reverse))
+
+    def _apply(self, kind, arg, indexes):
+        source = self.source
+        if kind == 'rect':
+            if arg is None:
+                return np.empty(0, dtype=np.int64)
+            return source.rect_indexes(arg, indexes)
+
+        if kind == 'text':
+            texts, minscore = arg
+            if minscore is None:
+                found = source.text_index.find_any(texts)
+            else:
+                found = source.text_index.fuzzy_any(texts, minscore)
+            found = np.array(found, dtype=np.int64)
+            if indexes is None:
+                return found
+            return indexes[np.isin(indexes, found)]
+
+        if indexes is None:
+            indexes = np.arange(source.count)
+
+        items = source.items
+        if kind == 'regexp':
+            mask = [ bool(arg.match(items[i].text)) for i in indexes ]
+        elif kind == 'filter':
+            mask = [ bool(arg(items[i])) for i in indexes ]
+        else:
+            return fail(f"Unknown query step: {kind}")
+
+        return indexes[np.array(mask, dtype=bool)]
+
+    def _order(self, key, reverse, indexes):
+        column_key = COLUMN_KEYS.get(key) if isinstance(key, str) else None
+        if column_key is not None:
+            values = column_key(self.source.cols[indexes])
+            return np.argsort(-values if reverse else values, kind='stable')
+
+        items = self.source.items
+        item_key = to_lambda(key)
+        order = sorted(range(len(indexes)),
+            key=lambda j: item_key(items[indexes[j]]), reverse=reverse)
+        return np.array(order, dtype=np.int64)
+
+    def _run(self):
+        indexes = None
+        for kind, arg in sorted(self.steps, key=lambda step: STEP_COSTS[step[0]]):
+            indexes = self._apply(kind, arg, indexes)
+            if len(indexes) == 0:
+                break
+
+        if indexes is None:
+            indexes = np.arange(self.source.count)
+
+        for key, reverse in self.orders:
+            indexes = indexes[self._order(key, reverse, indexes)]
+
+        return indexes
+
+    @property
+    def indexes(self):
+        if self._indexes is None:
+            self._indexes = self._run()
+        return self._indexes
+
+    def collect(self):
+        if self._result is None:
+            self._result = self.source.take(self.indexes)
+        return self._result
+
+    def __iter__(self):
+        items = self.source.items
+        return (items[i] for i in self.indexes)
+
+    @property
+    def count(self):
+        return len(self.indexes)
+
+    @property
+    def img(self):
+        return self.source.img
+
+    @property
+    def origin(self):
+        return self.source.origin or self.source
+
+    @property
+    def derived(self):
+        return True
+
+    @property
+    def items(self):
+        return self.collect().items
+
+    @property
+    def raw(self):
+        return self.collect().raw
+
+    @property
+    def cols(self):
+        return self.collect().cols
+
+    def create_empty(self):
+        return self.source.create_empty()
+
+    def take(self, indexes):
+        return self.collect().take(indexes)
+
+    def nearest(self, x, y):
+        return self.collect().nearest(x, y)
+
+    def best(self, key, reverse=False):
+        indexes = self.indexes
+        if len(indexes) == 0:
+            return None
+
+        items = self.source.items
+        column_key = COLUMN_KEYS.get(key) if isinstance(key, str) else None
+        if column_key is None:
+            item_key = to_lambda(key)
+            select = max if reverse else min
+            return select((items[i] for i in indexes), key=item_key)
+
+        values = column_key(self.source.cols[indexes])
+        pos = np.argmax(values) if reverse else np.argmin(values)
+        return items[indexes[pos]]
+
+    def top(self, key, k, reverse=False):
+        indexes = self.indexes
+        column_key = COLUMN_KEYS.get(key) if isinstance(key, str) else None
+        if column_key is None or k >= len(indexes):
+            order = self._order(key, reverse, indexes)[:k]
+            return self.source.take(indexes[order])
+
+        if k <= 0:
             return self.create_empty()
 
-        x1, y1, x2, y2 = rect
-        return self.filter(lambda item: (x1 <= item.x <= x2) and (y1 <= item.y <= y2))
+        values = column_key(self.source.cols[indexes])
+        if reverse:
+            values = -values
+
+        kth = np.partition(values, k - 1)[k - 1]
+        less = np.flatnonzero(values < kth)
+        equal = np.flatnonzero(values == kth)[:k - len(less)]
+        part = np.concatenate([less, equal])
+        part = part[np.lexsort((part, values[part]))]
+        return self.source.take(indexes[part])
 
 
 def make_ocr_item(t, dx, dy):
@@ -184,8 +664,21 @@ def make_ocr_item(t, dx, dy):
     return OcrItem(Rect(x1, y1, x2, y2), text, probability, bbox)
 
 
+def make_ocr_columns(items):
+    data = [
+        (item.rect.x1, item.rect.y1, item.rect.x2, item.rect.y2, item.x, item.y, item.probability)
+        for item in items
+    ]
+    return np.array(data, dtype=np.float64).reshape(-1, len(OCR_COLUMNS))
+
+
+def get_urls(value):
+    if isinstance(value, str):
+        value = value.split(',')
+    return [ url.strip() for url in value or [] if url.strip() ]
+
 def _init():
-    ocr = OcrClient()
+    ocr = OcrClient(get_urls(environment.ocr_urls))
     environment.components.ocr = ocr
 
 _init()
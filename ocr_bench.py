@@ -0,0 +1,163 @@
+import json
+import shutil
+import sys
+from argparse import ArgumentParser
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import time, sleep
+
+import numpy as np
+from requests import get as http_request
+
+OCR_SERVER_URL = 'http://localhost:1914/test'
+PERCENTILES = (50, 95, 99)
+
+Sample = namedtuple('Sample', ['started_at', 'duration', 'status'])
+
+def find_inputs(dn):
+    dn = Path(dn)
+    result = sorted(fn for fn in dn.rglob('*.npy') if fn.parent.name == 'ocr')
+    if not result:
+        result = sorted(dn.glob('*.npy'))
+    return result
+
+def copy_inputs(fns, work_dn):
+    result = []
+    for i, fn in enumerate(fns):
+        dst = Path(work_dn) / f'{i:05d}.npy'
+        shutil.copyfile(fn, dst)
+        result.append(dst)
+    return result
+
+def replay(url, fn, *, start_at, lang, timeout, priority): #pylint: disable=too-many-arguments
+    delay = start_at - time()
+    if delay > 0.0:
+        sleep(delay)
+
+    params = {
+        'fn': str(fn),
+        'deadline': f'{time() + timeout:.3f}',
+        'priority': priority,
+    }
+    if lang:
+        params['lang'] = lang
+
+    started_at = time()
+    try:
+        response = http_request(url, params, timeout=timeout)
+        try:
+            status = response.json().get('status', str(response.status_code))
+        except ValueError:
+            status = str(response.status_code)
+    except Exception as e: #pylint: disable=broad-exception-caught
+        status = e.__class__.__name__
+
+    return Sample(started_at, time() - started_at, status)
+
+def make_report(samples, **kwargs):
+    statuses = Counter(sample.status for sample in samples)
+    qrequests = len(samples)
+    qerrors = qrequests - statuses['OK']
+
+    first = min(sample.started_at for sample in samples)
+    last = max(sample.started_at + sample.duration for sample in samples)
+    duration = last - first
+
+    report = dict(kwargs)
+    report['requests'] = qrequests
+    report['duration_sec'] = round(duration, 3)
+    report['throughput_rps'] = round(statuses['OK'] / duration, 3) if duration > 0.0 else None
+    report['error_rate'] = round(qerrors / qrequests, 4)
+    report['statuses'] = dict(statuses)
+
+    durations = [ sample.duration for sample in samples if sample.status == 'OK' ]
+    if durations:
+        latency = { f'p{q}': round(float(np.percentile(durations, q)), 4) for q in PERCENTILES }
+        latency['mean'] = round(float(np.mean(durations)), 4)
+        latency['max'] = round(float(np.max(durations)), 4)
+        report['latency_sec'] = latency
+
+    return report
+
+def run(dn, *, url, concurrency, rate, qrequests, lang, timeout, priority): #pylint: disable=too-many-arguments
+    fns = find_inputs(dn)
+    if not fns:
+        print(f"No OCR inputs found in {dn}", file=sys.stderr)
+        return None
+
+    qrequests = qrequests or len(fns)
+    print(f"Replay {qrequests} requests from {len(fns)} files to {url}", file=sys.stderr)
+
+    with TemporaryDirectory(prefix='ocr-bench-') as work_dn:
+        fns = copy_inputs(fns, work_dn)
+
+        start_at = time()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = []
+            for i in range(qrequests):
+                at = start_at + i / rate if rate else start_at
+                futures.append(pool.submit(replay, url, fns[i % len(fns)],
+                    start_at=at, lang=lang, timeout=timeout, priority=priority))
+            samples = [ future.result() for future in futures ]
+
+    return make_report(samples,
+        url=url,
+        files=len(fns),
+        concurrency=concurrency,
+        rate=rate,
+    )
+
+def _main():
+    parser = ArgumentParser(description='Replay captured OCR inputs against ocr_server.py')
+
+    parser.add_argument('dn', type=str,
+        help='Directory with captured ocr/NNNN.npy files (searched recursively)')
+
+    parser.add_argument('-u', '--url', type=str, default=OCR_SERVER_URL,
+        help=f'OCR server URL (default: {OCR_SERVER_URL})')
+
+    parser.add_argument('-c', '--concurrency', type=int, default=4,
+        help='Number of concurrent clients (default: 4)')
+
+    parser.add_argument('-r', '--rate', type=float, default=0.0,
+        help='Request rate per second, 0 means as fast as possible (default: 0)')
+
+    parser.add_argument('-n', '--requests', type=int, default=0,
+        help='Number of requests, 0 means one per file (default: 0)')
+
+    parser.add_argument('-l', '--lang', type=str, default=None,
+        help='Additional OCR language (optional)')
+
+    parser.add_argument('-t', '--timeout', type=float, default=60.0,
+        help='Request timeout in seconds (default: 60)')
+
+    parser.add_argument('-p', '--priority', type=int, default=10,
+        help='Request priority (default: 10)')
+
+    parser.add_argument('-o', '--output', type=str, default=None,
+        help='Write the JSON report to a file instead of stdout')
+
+    args = parser.parse_args()
+    report = run(args.dn,
+        url=args.url,
+        concurrency=args.concurrency,
+        rate=args.rate,
+        qrequests=args.requests,
+        lang=args.lang,
+        timeout=args.timeout,
+        priority=args.priority,
+    )
+    if report is None:
+        sys.exit(1)
+
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w', encoding='utf-8') as outf:
+            print(text, file=outf)
+
+if __name__ == '__main__':
+    _main()
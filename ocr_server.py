@@ -1,6 +1,14 @@
 import json
+import traceback
+from bisect import bisect_left
+from collections import Counter
+from hashlib import blake2b
+from itertools import count
 from pathlib import Path
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import PriorityQueue, Full as QueueIsFull
+from threading import Event, Lock, Thread
+from time import time
 from urllib.parse import parse_qs, urlparse
 
 import cv2
@@ -11,31 +19,231 @@ PORT = 1914
 BASE_DN = Path.home() / 'data' / 'qazwsx'
 FONT = cv2.FONT_HERSHEY_SIMPLEX
 
+QUEUE_SIZE = 16
+DEFAULT_TIMEOUT = 60
+DEFAULT_PRIORITY = 10
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
 readers = {}
+stats = Counter()
+started_at = time()
 
 class BadParams(Exception):
     pass
 
+class Busy(Exception):
+    pass
+
+class Expired(Exception):
+    pass
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def dump(self):
+        with self.lock:
+            counts = list(self.counts)
+            result = { 'count': self.count, 'sum': round(self.sum, 6), 'buckets': {} }
+
+        total = 0
+        for bound, q in zip(self.buckets + ('+Inf',), counts):
+            total += q
+            result['buckets'][str(bound)] = total
+        return result
+
+latencies = {
+    'decode': Histogram(),
+    'queue': Histogram(),
+    'inference': Histogram(),
+    'serialization': Histogram(),
+    'total': Histogram(),
+}
+
+reader_stats = {}
+
+def get_reader_memory(reader):
+    result = 0
+    for name in ('detector', 'recognizer'):
+        model = getattr(reader, name, None)
+        parameters = getattr(model, 'parameters', None)
+        if parameters is None:
+            continue
+        result += sum(p.numel() * p.element_size() for p in parameters())
+    return result
+
 def get_reader(langs):
     key = ':'.join(langs)
     result = readers.get(key)
     if result:
+        stats['reader_hits'] += 1
         return result
 
+    stats['reader_misses'] += 1
+    start = time()
     result = easyocr.Reader(langs,
         model_storage_directory=BASE_DN / 'easyocr',
         gpu=True, verbose=True,
     )
+    duration = time() - start
 
     print('Created reader', key)
     readers[key] = result
+    reader_stats[key] = {
+        'load_sec': round(duration, 3),
+        'memory_bytes': get_reader_memory(result),
+    }
     return result
 
+def get_job_key(img, langs):
+    digest = blake2b(digest_size=16)
+    digest.update(str((img.shape, img.dtype.str)).encode('utf-8'))
+    digest.update(np.ascontiguousarray(img))
+    return digest.hexdigest(), tuple(langs)
+
+class Job: #pylint: disable=too-many-instance-attributes,too-few-public-methods
+    def __init__(self, img, langs, deadline, priority):
+        self.img = img
+        self.langs = langs
+        self.key = get_job_key(img, langs)
+        self.deadline = deadline
+        self.priority = priority
+        self.done = Event()
+        self.queued_at = time()
+        self.ocrs = None
+        self.error = None
+
+    def finish(self, ocrs=None, error=None):
+        self.ocrs = ocrs
+        self.error = error
+        self.done.set()
+
+class Scheduler:
+    def __init__(self, size=QUEUE_SIZE):
+        self.queue = PriorityQueue(maxsize=size)
+        self.counter = count()
+        self.thread = None
+        self.lock = Lock()
+        self.inflight = {}
+
+    def start(self):
+        self.thread = Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, job):
+        with self.lock:
+            current = self.inflight.get(job.key)
+            if current is not None:
+                current.deadline = max(current.deadline, job.deadline)
+                stats['coalesced'] += 1
+                return current
+
+            entry = (-job.priority, job.deadline, next(self.counter), job)
+            try:
+                self.queue.put_nowait(entry)
+            except QueueIsFull as e:
+                stats['busy'] += 1
+                raise Busy(f"Queue is full: {self.queue.maxsize} requests") from e
+
+            self.inflight[job.key] = job
+            stats['queued'] += 1
+            return job
+
+    def finish(self, job, **kwargs):
+        with self.lock:
+            self.inflight.pop(job.key, None)
+        job.finish(**kwargs)
+
+    def _loop(self):
+        while True:
+            *_, job = self.queue.get()
+            latencies['queue'].observe(time() - job.queued_at)
+            if time() >= job.deadline:
+                stats['dropped'] += 1
+                self.finish(job, error=Expired("Deadline expired in the queue"))
+                continue
+
+            try:
+                reader = get_reader(job.langs)
+                start = time()
+                ocrs = list(reader.readtext(job.img))
+                latencies['inference'].observe(time() - start)
+                stats['recognized'] += 1
+                self.finish(job, ocrs=ocrs)
+            except Exception as e: #pylint: disable=broad-exception-caught
+                stats['failed'] += 1
+                self.finish(job, error=e)
+
+    def get_stats(self):
+        with self.lock:
+            result = dict(stats)
+            result['queue_depth'] = self.queue.qsize()
+            result['inflight'] = len(self.inflight)
+        return result
+
+    def get_metrics(self):
+        def rate(hits, misses):
+            total = stats[hits] + stats[misses]
+            return round(stats[hits] / total, 4) if total else None
+
+        return {
+            'uptime_sec': round(time() - started_at, 3),
+            'requests': self.get_stats(),
+            'latency_sec': { name: hist.dump() for name, hist in latencies.items() },
+            'readers': dict(reader_stats),
+            'cache': {
+                'readers': rate('reader_hits', 'reader_misses'),
+                'coalescing': rate('coalesced', 'queued'),
+            },
+        }
+
+scheduler = Scheduler()
+
+def get_param(query_params, name, cast, default):
+    value = query_params.get(name)
+    if not value:
+        return default
+
+    try:
+        return cast(value[0])
+    except ValueError as e:
+        raise BadParams(f"Invalid {name}: {value[0]}") from e
+
 class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
+    def send_json(self, code, response):
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+
+        self.wfile.write(json.dumps(response).encode("utf-8"))
+        self.wfile.write(b'\n')
+        self.wfile.flush()
+        self.connection.close()
+
     def do_GET(self): #pylint: disable=invalid-name
         parsed_path = urlparse(self.path)
         query_params = parse_qs(parsed_path.query)
 
+        if parsed_path.path == '/stats':
+            self.send_json(200, { 'status': 'OK', 'stats': scheduler.get_stats() })
+            return
+
+        if parsed_path.path == '/metrics':
+            self.send_json(200, { 'status': 'OK', 'metrics': scheduler.get_metrics() })
+            return
+
+        started = time()
         try:
             lang = query_params.get('lang')
             if lang:
@@ -48,6 +256,9 @@ class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
             if lang:
                 langs.append(lang)
 
+            deadline = get_param(query_params, 'deadline', float, time() + DEFAULT_TIMEOUT)
+            priority = get_param(query_params, 'priority', int, DEFAULT_PRIORITY)
+
             fn_param = query_params.get('fn')
             if not fn_param:
                 raise BadParams("No fn in query_params")
@@ -63,32 +274,38 @@ class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
                 img = np.load(fn)
             else:
                 raise BadParams("Unsupported file format")
+            latencies['decode'].observe(time() - started)
 
-            reader = get_reader(langs)
-            ocrs = list(reader.readtext(img))
-
-            response = {
-                'status': 'OK',
-                'texts': [str(item) for item in ocrs],
-            }
+            stats['requests'] += 1
+            job = scheduler.submit(Job(img, langs, deadline, priority))
+            if not job.done.wait(max(deadline - time(), 0.0)):
+                stats['expired'] += 1
+                raise Expired("Deadline expired before the recognition")
 
-            self.send_response(200)
-        except Exception as e:
-            response = {
-                'status': 'FAIL',
-                'message': str(e)
-            }
+            if job.error is not None:
+                raise job.error
 
-            self.send_response(400)
-            raise
+            ocrs = job.ocrs
+        except Busy as e:
+            self.send_json(503, { 'status': 'BUSY', 'message': str(e) })
+            return
+        except Expired as e:
+            self.send_json(504, { 'status': 'EXPIRED', 'message': str(e) })
+            return
+        except Exception as e: #pylint: disable=broad-exception-caught
+            stats['errors'] += 1
+            traceback.print_exc()
+            self.send_json(400, { 'status': 'FAIL', 'message': str(e) })
+            return
 
-        self.send_header("Content-Type", "application/json")
-        self.end_headers()
-
-        self.wfile.write(json.dumps(response).encode("utf-8"))
-        self.wfile.write(b'\n')
-        self.wfile.flush()
-        self.connection.close()
+        start = time()
+        response = {
+            'status': 'OK',
+            'texts': [str(item) for item in ocrs],
+        }
+        self.send_json(200, response)
+        latencies['serialization'].observe(time() - start)
+        latencies['total'].observe(time() - started)
 
         if img.shape[2] == 4:
             img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
@@ -120,10 +337,11 @@ class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
                 f.write(f"{i:02d}: {line}\n")
 
 
-def run(server_class=HTTPServer, handler_class=SimpleHTTPRequestHandler, port=None):
+def run(server_class=ThreadingHTTPServer, handler_class=SimpleHTTPRequestHandler, port=None):
     port = port or PORT
     server_address = ('', port)
     httpd = server_class(server_address, handler_class)
+    scheduler.start()
     print(f"Starting http server on port {port}")
     httpd.serve_forever()
 
@@ -89,8 +89,12 @@ def _main():
     environment.snapshot_name = snapshot_name
     environment.start_pause = get('start_pause', int)
     environment.time_scale = get('time_scale', float)
+    environment.detect_mode = get('detect_mode', str)
+    environment.detect_processes = get('detect_processes', int)
+    environment.panel_layouts = get('panel_layouts', bool)
+    environment.ocr_urls = config.get('ocr_urls', environment.ocr_urls)
 
-    providers = ('logger', 'video', 'effector', 'ocr')
+    providers = ('logger', 'video', 'effector', 'ocr', 'labels')
     for provider in providers:
         __import__(f'providers.{provider}')
 